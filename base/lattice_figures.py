@@ -119,7 +119,7 @@ if __name__ == "__main__":
         adj[adj!=0] = 1
         
         sorted_indices = np.random.permutation(np.arange(adj.shape[0]))
-        block = ta.get_tree_slow(sorted_indices, adj=adj)
+        block = ta.get_tree(sorted_indices, adj=adj)
         selected = np.zeros(nrows*ncols)
 
         selected[block] = 1
@@ -277,7 +277,7 @@ def gradient_approx(x, f_func, n_params=3, eps=1e-7):
   for n in range(n_params):
     
     e[n] = 1.
-    val = f_func(x + e * np.complex(0, eps))
+    val = f_func(x + e * complex(0, eps))
     gA[n] = np.imag(val) / eps
     e[n] = 0
 
@@ -0,0 +1,124 @@
+import numpy as np
+
+from base import utils as ut
+from selection_rules import tree_algorithms as ta
+from update_rules import update_rules as ur
+
+
+# The monotone check is opt-in (-ad 1): rules such as LS, SDDM and the
+# Huber/logistic bp losses are not guaranteed to decrease every step
+DEFAULT_CHECKS = {"monotone": 0, "exact_gabp": "once", "partition": "once",
+                  "gradient": 0}
+
+
+class CheckedMode:
+    """Correctness checks run alongside the solver loop.
+
+    `checks` maps a check name ("monotone", "exact_gabp", "partition" or
+    "gradient") to how often it runs: 0 never, "once" at its first
+    opportunity, and k >= 1 every k iterations. A (frequency, p) pair
+    additionally runs a due check with probability p only. The checks
+    draw from their own generator, so enabling them does not change the
+    iterates of a seeded run.
+    """
+    def __init__(self, checks=None, seed=0):
+        self.checks = dict(DEFAULT_CHECKS)
+        if checks is not None:
+            self.checks.update(checks)
+
+        self.rng = np.random.RandomState(seed)
+        self.done = set()
+
+    def due(self, name, iteration=0):
+        every = self.checks.get(name, 0)
+        prob = 1.
+        if isinstance(every, tuple):
+            every, prob = every
+
+        if every == "once":
+            if name in self.done:
+                return False
+        elif not every or iteration % every != 0:
+            return False
+
+        if prob < 1. and self.rng.rand() >= prob:
+            return False
+
+        self.done.add(name)
+
+        return True
+
+    def monotone(self, iteration, loss, prev_loss, tol=1e-6):
+        if not self.due("monotone", iteration):
+            return
+
+        if loss > prev_loss + tol * max(1., abs(prev_loss)):
+            raise ValueError("loss value has increased...")
+
+    def exact_gabp(self, iteration, A, b, loss, args, block):
+        """bpExact and bpGabp agree on a random point for a tree block."""
+        if not self.due("exact_gabp", iteration):
+            return
+
+        # Shallow copies: neither update writes into the arrays of args.
+        # update_block leaves the loss's cached products at the iterate
+        xr = self.rng.randn(A.shape[1])
+        xE, _ = ur.update_block("bpExact", xr.copy(),
+                                A, b, loss, dict(args), block, iteration)
+        xG, _ = ur.update_block("bpGabp", xr.copy(),
+                                A, b, loss, dict(args), block, iteration)
+
+        np.testing.assert_array_almost_equal(xE, xG, 3)
+        print("Exact vs GaBP Test passed...")
+
+    def partition(self, kind, graph_blocks, adj):
+        """Red-black blocks are independent sets of adj and tree
+        partition blocks are forests of it."""
+        if not self.due("partition"):
+            return
+
+        for block in graph_blocks:
+            if kind == "RedBlack":
+                assert ta.isIndependentSet(adj, block)
+            elif kind == "Tree":
+                assert ta.isForest(adj, block)
+            else:
+                raise ValueError("%s - No" % kind)
+
+    def gradient(self, iteration, x, A, b, loss, n_coords=3, tol=1e-4):
+        """g_func matches finite differences of f_func on a few random
+        coordinates."""
+        if not self.due("gradient", iteration):
+            return
+
+        ind = np.sort(self.rng.choice(x.size, min(n_coords, x.size),
+                                      replace=False))
+
+        def f_ind(z):
+            x_z = x.astype(np.result_type(x, z))
+            x_z[ind] = z
+
+            return loss.f_func(x_z, A, b)
+
+        g = loss.g_func(x, A, b, block=ind)
+
+        # Complex step first; losses that are not analytic in x (e.g.
+        # the Huber and logistic ones) get central differences
+        try:
+            gA = ut.gradient_approx(x[ind], f_ind, n_params=ind.size)
+        except TypeError:
+            gA = None
+
+        if gA is None or not close(g, gA, tol):
+            eps = 1e-6
+            gA = np.zeros(ind.size)
+            for n in range(ind.size):
+                e = np.zeros(ind.size)
+                e[n] = eps
+                gA[n] = (f_ind(x[ind] + e) - f_ind(x[ind] - e)) / (2 * eps)
+
+        assert close(g, gA, tol), ("gradient check failed", g, gA)
+
+
+def close(g, gA, tol):
+    return np.linalg.norm(g - gA) <= tol * max(1., np.linalg.norm(g))
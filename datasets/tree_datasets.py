@@ -1,17 +1,16 @@
 import numpy as np
+from scipy import sparse
 from scipy.io import savemat, loadmat
 from base import utils as ut 
 
 
-def generate_datasets_D_or_E(root, name):
+def generate_datasets_D_or_E(root, name, nrows=50, ncols=50):
     ##################################################
     # 1. Get the weighted edges 'W' and the labels 'y'
     ##################################################
 
     if name == "ising" or name == "dataset_d":
         # Dataset D - Lattice based quadratic
-        nrows = 50 
-        ncols = 50
         lattice = True
 
         # Generate the weighted edges 'W' and the labels 'y'
@@ -27,7 +26,7 @@ def generate_datasets_D_or_E(root, name):
         W, y, ytrue, features = nearest_Wy(root)
 
     # Assert that the diagonals are zero
-    assert np.diag(W).sum() == 0
+    assert sparse.csr_matrix(W).diagonal().sum() == 0
 
     ##################################################
     # 2. Formulate the problem as a linear system Ax=b
@@ -37,27 +36,8 @@ def generate_datasets_D_or_E(root, name):
     unlabeled_indices = (y == 0).ravel()
     labeled_indices = (y != 0).ravel()
     
-    n = y.size
-
-    # Initialize A and b and fill their values based on the 
-    # formulation: 0.5 * \sum_{ij} Wij (xi-xj)**2
-    A = np.zeros((n, n))
-    b = np.zeros(n)
-
-    for i in range(n):
-        W_mi = W[labeled_indices, i]
-        b[i] = np.sum(W_mi * y[labeled_indices])
-
-        for j in range(n):
-            if i == j:
-                A[i, j] = np.sum(W[:, i])
-            else:
-                A[i, j] = - W[i, j]
-
-    # Grab only the unlabeled indices as the dataset
-    A = A[unlabeled_indices][:, unlabeled_indices]
-    b = b[unlabeled_indices]
-
+    # A and b follow the formulation: 0.5 * \sum_{ij} Wij (xi-xj)**2
+    A, b = laplacian_system(W, y)
 
     return A, b, {"data_lattice":lattice,"data_nrows":nrows, 
                   "data_ncols":ncols, "data_W":W, "data_y":y, 
@@ -67,45 +47,76 @@ def generate_datasets_D_or_E(root, name):
                   "features": features}
 
 
-def ising_Wy(nrows=50, ncols=50):
-    # For dataset D
-    np.random.seed(1)
+def laplacian_system(W, y):
+    """Eliminates the labeled nodes from the graph Laplacian of W.
+
+    Returns A = (D - W)[U, U] in CSR format, where D holds the degrees
+    (column sums of W) and U are the unlabeled nodes, and 
+    b = W[L, U]^T y[L], where L are the labeled nodes.
+    """
+    W = sparse.csr_matrix(W, dtype=float)
+    y = np.asarray(y, dtype=float).ravel()
+
+    labeled = y != 0
+    unlabeled = ~labeled
+
+    degrees = np.asarray(W.sum(axis=0)).ravel()
+    laplacian = (sparse.diags(degrees) - W).tocsr()
+
+    A = laplacian[unlabeled][:, unlabeled]
+    A.sort_indices()
+
+    b = W[labeled][:, unlabeled].T.dot(y[labeled])
+
+    return A, b
+
+
+def lattice_edges(nrows, ncols):
+    """Returns the (source, target) node pairs of the edges of an
+    nrows x ncols lattice, with node i at row i % nrows and column 
+    i // nrows. Each edge appears once."""
+    nodes = np.arange(nrows * ncols).reshape(ncols, nrows).T
+
+    # Vertical edges (i, i + 1) and horizontal edges (i, i + nrows)
+    source = np.concatenate([nodes[:-1, :].ravel(), nodes[:, :-1].ravel()])
+    target = np.concatenate([nodes[1:, :].ravel(), nodes[:, 1:].ravel()])
+
+    return source, target
+
+
+def lattice_Wy(nrows=50, ncols=50, weight=1e5, labeled_fraction=0.04, 
+               seed=1):
+    """Lattice-structured label propagation problem.
+
+    Returns the symmetric CSR weights W, with `weight` on every lattice
+    edge, and labels y that are non-zero for a random `labeled_fraction`
+    of the nodes.
+    """
+    np.random.seed(seed)
 
     # CREATE "W"
     n = ncols * nrows
-    W = np.zeros((n, n))
-
-    for i in range(n):
-        r = int(i % nrows)
-        c = int(i / nrows)
-
-        Wval = 1e5
-        # Case 0: Bottom-right node
-        if c == (ncols - 1) and r == (nrows - 1):
-            pass
-
-        # Case 1: Node in Right most edge
-        elif c == (ncols - 1) and r != (nrows - 1):
-            W[i, i + 1] = Wval
- 
-        # Case 1: Node in Bottom edge
-        elif r == (nrows - 1):
-            W[i, i + nrows] = Wval
-
-        # Case 3: Left-Middle Edge node
-        else: 
-            W[i, i + 1] = Wval
-            W[i, i + nrows] = Wval
-            
-    
+    source, target = lattice_edges(nrows, ncols)
+    weights = np.full(source.size, weight, dtype=float)
+
+    W = sparse.coo_matrix((weights, (source, target)), shape=(n, n))
+
     # Make it undirected
-    W = W + np.tril(W.T, -1)
+    W = (W + W.T).tocsr()
 
     # Labels
-    ind = np.random.choice(n, 100, replace=False)
+    n_labeled = int(round(labeled_fraction * n))
+    ind = np.random.choice(n, n_labeled, replace=False)
     y = np.zeros(n)
 
-    y[ind] = np.random.randn(100) * 10.
+    y[ind] = np.random.randn(n_labeled) * 10.
+
+    return W, y
+
+
+def ising_Wy(nrows=50, ncols=50):
+    # For dataset D
+    W, y = lattice_Wy(nrows, ncols, weight=1e5, labeled_fraction=0.04)
 
     return W, y, None, None
 
@@ -1,6 +1,7 @@
 import numpy as np
-from scipy.special import logsumexp
+from scipy import sparse
 from scipy.linalg import eigh
+from scipy.sparse.linalg import LinearOperator
 
 from numba import jit
 
@@ -26,6 +27,212 @@ def create_lossObject(loss_name, A, b, args):
     if loss_name == "lsl1nn":
         return Least_Square_L1_NN(A, b, args)
 
+
+###########################
+# 0. Dense and sparse (CSC) data matrices
+###########################
+def dense(A):
+  # Dense copy of a sparse A, A itself otherwise
+  if sparse.issparse(A):
+    return A.toarray()
+
+  return A
+
+def columns(A, cols):
+  # Dense copy of the columns of A in cols
+  A_c = A[:, cols]
+  if sparse.issparse(A_c):
+    A_c = A_c.toarray()
+
+  return A_c
+
+def gram(A, w=None):
+  # Dense A^T diag(w) A
+  if w is None:
+    G = A.T.dot(A)
+  elif sparse.issparse(A):
+    G = A.T.dot(A.multiply(w[:, np.newaxis]))
+  else:
+    G = A.T.dot(A * w[:, np.newaxis])
+
+  if sparse.issparse(G):
+    G = G.toarray()
+
+  return G
+
+def column_power_sums(A, p):
+  # sum_i |A_ij|^p for every column j
+  if sparse.issparse(A):
+    return np.asarray(abs(A).power(p).sum(axis=0)).ravel()
+
+  return np.sum(np.abs(A) ** p, axis=0)
+
+def abs_gram_rowsum(A):
+  # |A|^T (|A| 1), the row sums of |A|^T |A| >= |A^T A|
+  abs_A = abs(A)
+
+  return abs_A.T.dot(abs_A.dot(np.ones(A.shape[1])))
+
+def block_grams(A, blocks, max_entries=2**22):
+  # Stacked Grams A[:, block]^T A[:, block] of the rows of blocks,
+  # densifying at most max_entries entries of A at a time
+  n_blocks, size = blocks.shape
+  G = np.empty((n_blocks, size, size))
+  step = max(1, max_entries // (A.shape[0] * size))
+
+  for i in range(0, n_blocks, step):
+    A_b = columns(A, blocks[i:i + step].ravel())
+    A_b = A_b.reshape(A.shape[0], -1, size).transpose(1, 0, 2)
+    G[i:i + step] = np.matmul(A_b.transpose(0, 2, 1), A_b)
+
+  return G
+
+def block_submatrices(A, blocks, max_size=2048):
+  # Stacked A[block][:, block] of the rows of blocks
+  n_blocks, size = blocks.shape
+  A_bb = np.empty((n_blocks, size, size))
+  step = max(1, max_size // size)
+
+  for i in range(0, n_blocks, step):
+    P = blocks[i:i + step].ravel()
+    c = P.size // size
+    M = dense(A[P][:, P]).reshape(c, size, c, size)
+    A_bb[i:i + step] = np.einsum('ikil->ikl', M)
+
+  return A_bb
+
+        
+###########################
+# 1. Cached matrix-vector products
+###########################
+class MatvecCache:
+  """Keeps A.dot(x) for the last committed iterate x.
+
+  Block coordinate methods only change a few coordinates of x per
+  iteration, so A.dot(x_new) is obtained from the cached product with
+  the columns of A that correspond to the changed coordinates. x can be
+  a vector or a (n_features, n_classes) matrix, in which case only the
+  classes touched by the changed coordinates are patched. The product
+  is recomputed from scratch every `refresh_every` commits to stop
+  round-off errors from accumulating.
+  """
+  def __init__(self, A, refresh_every=1000):
+    self.A = A
+    self.refresh_every = refresh_every
+
+    # Patches slice columns of A, which is cheap in CSC format
+    self.A_cols = A.tocsc() if sparse.issparse(A) else A
+    self.A_rows = None
+
+    self.x = None
+    self.Ax = None
+    self.n_patches = 0
+
+  def changed(self, x):
+    # Flat indices where x differs from the committed iterate, or None if
+    # patching would cost more than recomputing the product
+    if self.x is None or x.shape != self.x.shape:
+      return None
+
+    changed = np.flatnonzero(x != self.x)
+    if 3 * changed.size > x.size:
+      return None
+
+    return changed
+
+  def patch(self, x, changed):
+    delta = x.ravel()[changed] - self.x.ravel()[changed]
+
+    if x.ndim == 1:
+      return self.Ax + self.A_cols[:, changed].dot(delta)
+
+    # Rank-|changed| correction of the columns of the classes involved
+    features, classes = np.unravel_index(changed, x.shape)
+    U, f_ind = np.unique(features, return_inverse=True)
+    C, c_ind = np.unique(classes, return_inverse=True)
+
+    D = np.zeros((U.size, C.size), dtype=delta.dtype)
+    np.add.at(D, (f_ind, c_ind), delta)
+
+    Ax = self.Ax.astype(D.dtype)
+    Ax[:, C] += self.A_cols[:, U].dot(D)
+
+    return Ax
+
+  def patched(self, x):
+    """Returns A.dot(x) and the coordinates in which x differs from the
+    committed iterate (None if the product was recomputed)."""
+    if self.x is None:
+      self.commit(x)
+
+    changed = self.changed(x)
+
+    if changed is None:
+      return self.A.dot(x), None
+
+    if changed.size == 0:
+      return self.Ax, changed
+
+    return self.patch(x, changed), changed
+
+  def product(self, x):
+    return self.patched(x)[0]
+
+  def rows(self, x, rows):
+    """Returns A.dot(x)[rows] without forming the full product."""
+    if self.x is None:
+      self.commit(x)
+
+    changed = self.changed(x)
+
+    if changed is None:
+      return self.A[rows].dot(x)
+
+    Ax_rows = self.Ax[rows]
+
+    if changed.size > 0:
+      delta = x[changed] - self.x[changed]
+      Ax_rows = Ax_rows + self.A[np.ix_(rows, changed)].dot(delta)
+
+    return Ax_rows
+
+  def neighbors(self, rows):
+    """Columns of the non-zeros in the rows of A."""
+    if self.A_rows is None:
+      self.A_rows = self.A.tocsr() if sparse.issparse(self.A) else self.A
+
+    if sparse.issparse(self.A_rows):
+      return np.unique(self.A_rows[rows].indices)
+
+    return np.flatnonzero(np.any(self.A_rows[rows] != 0, axis=0))
+
+  def coupled(self, cols):
+    """Columns of A that share a non-zero row with cols, i.e. the
+    non-zero pattern of (A^T A)[:, cols]."""
+    A_c = self.A_cols[:, cols]
+    if sparse.issparse(A_c):
+      rows = np.unique(A_c.indices)
+    else:
+      rows = np.flatnonzero(np.any(A_c != 0, axis=1))
+
+    return np.union1d(self.neighbors(rows), cols)
+
+  def commit(self, x):
+    changed = self.changed(x)
+
+    if changed is None or self.n_patches >= self.refresh_every:
+      self.Ax = self.A.dot(x)
+      self.n_patches = 0
+      changed = None
+
+    elif changed.size > 0:
+      self.Ax = self.patch(x, changed)
+      self.n_patches += 1
+
+    self.x = x.copy()
+
+    return changed
+
         
 ###########################
 # 2. Least_Square
@@ -35,22 +242,44 @@ class Least_Square:
     self.ylabel = "bp loss: $f(x) = \\frac{1}{2} x^T A x - b^Tx$"
     self.L2 = args["L2"]
     self.n_params = A.shape[1]
-    self.lipschitz = np.sum(A ** 2, axis=0) + self.L2
+    self.lipschitz = column_power_sums(A, 2) + self.L2
+    self.Hb_rowsum = None
+
+    # Ax is patched after every block update so that
+    # the residual Ax - b never needs a full matvec
+    self.cache = MatvecCache(A)
+
+  def commit(self, x):
+    self.cache.commit(x)
 
   def f_func(self, x, A, b):
     reg = 0.5 * self.L2 * np.sum(x ** 2) 
 
-    b_pred = np.dot(A, x) 
+    b_pred = self.cache.product(x)
     
     loss = 0.5 * np.sum((b_pred - b)**2) + reg
 
     return loss
 
+  def f_delta(self, x, changed, delta, A, b):
+    # f(x) - f(x_old) where x_old[changed] = x[changed] - delta
+    residual = self.cache.product(x) - b
+    u = A[:, changed].dot(delta)
+
+    x_old = x[changed] - delta
+    reg = 0.5 * self.L2 * np.sum(x[changed] ** 2 - x_old ** 2)
+
+    return residual.dot(u) - 0.5 * u.dot(u) + reg
+
+  def coupled(self, A, block):
+    # Coordinates whose gradient depends on x[block]
+    return self.cache.coupled(block)
+
   def g_func(self, x, A, b, block=None):
-    b_pred = np.dot(A, x)
+    b_pred = self.cache.product(x)
     residual = b_pred - b
     if block is None:
-      grad = np.dot(A.T, residual)
+      grad = A.T.dot(residual)
 
       grad += self.L2 * x
     else:
@@ -63,43 +292,71 @@ class Least_Square:
     #b_pred = np.dot(A, x)
 
     if block is None:
-      hessian = np.dot(A.T, A)
+      hessian = gram(A)
       hessian += self.L2 * np.identity(self.n_params)
       
     elif block.size == 1:
       #import ipdb; ipdb.set_trace()
-      hessian = np.sum(A[:, block[0]]**2)      
+      hessian = column_power_sums(A[:, block], 2)[0]
       hessian += self.L2
       
     else:
       # Block case
-      hessian = np.dot(A[:, block].T, A[:, block])
+      hessian = gram(A[:, block])
       hessian += self.L2 * np.identity(block.size)
 
     return hessian 
 
   def Lb_func(self, x, A, b, block=None):
     if block is None:
-      E = np.linalg.eig(A.T.dot(A))[0]
+      E = np.linalg.eig(gram(A))[0]
       L_block = np.max(E) + self.L2
     else:
       A_b = A[:, block]
 
-      E = np.linalg.eig(A_b.T.dot(A_b))[0]
+      E = np.linalg.eig(gram(A_b))[0]
       L_block = np.max(E) + self.L2
     
     return L_block
 
+  def Lb_batch(self, x, A, b, blocks):
+    # Lb_func of every row of blocks
+    E = np.linalg.eigvalsh(block_grams(A, blocks))
+
+    return E[:, -1] + self.L2
+
   def Hb_func(self, x, A, b, block=None):
     if block is None:
-      L_block = np.dot(A.T, A)
+      L_block = gram(A)
       L_block += self.L2 * np.identity(self.n_params)
     else:
       A_b = A[:, block]
-      L_block = A_b.T.dot(A_b) + self.L2 * np.identity(block.size)
+      L_block = gram(A_b) + self.L2 * np.identity(block.size)
     
     return L_block
 
+  def Hb_batch(self, x, A, b, blocks):
+    # Hb_func of every row of blocks, stacked
+    return block_grams(A, blocks) + self.L2 * np.identity(blocks.shape[1])
+
+  def Hb_full_blocks(self, x, A, b, blocks):
+    # Blocks of Hb_func(block=None), the same as Hb_batch here
+    return self.Hb_batch(x, A, b, blocks)
+
+  def Hb_operator(self, x, A, b):
+    # Hb_func(block=None) as v -> A^T (A v) + L2 v
+    matvec = lambda v: A.T.dot(A.dot(v)) + self.L2 * v
+
+    return LinearOperator((self.n_params, self.n_params), matvec=matvec,
+                          rmatvec=matvec, dtype=float)
+
+  def Hb_abs_rowsum(self, x, A, b):
+    # Bound on np.sum(np.abs(Hb_func(block=None)), 1) that does not form Hb
+    if self.Hb_rowsum is None:
+      self.Hb_rowsum = abs_gram_rowsum(A) + self.L2
+
+    return self.Hb_rowsum
+
 
 ###########################
 # 2. Least_Square_L1_NN
@@ -113,25 +370,42 @@ class Least_Square_L1_NN:
     
     assert self.L1 != 0
 
-    self.lipschitz = np.sum(A ** 2, axis=0) + self.L2
+    self.lipschitz = column_power_sums(A, 2) + self.L2
+    self.Hb_rowsum = None
+
+    self.cache = MatvecCache(A)
+
+  def commit(self, x):
+    self.cache.commit(x)
 
   def f_func(self, x, A, b, assert_nn=1):
     # Least squares function    
     assert np.all(x >= 0)
     
-    b_pred = np.dot(A, x) 
+    b_pred = self.cache.product(x)
     
     loss = 0.5 * np.sum((b_pred - b)**2) + self.L1 * np.sum(x)
 
     return loss
 
+  def f_delta(self, x, changed, delta, A, b):
+    # f(x) - f(x_old) where x_old[changed] = x[changed] - delta
+    residual = self.cache.product(x) - b
+    u = A[:, changed].dot(delta)
+
+    return residual.dot(u) - 0.5 * u.dot(u) + self.L1 * np.sum(delta)
+
+  def coupled(self, A, block):
+    # Coordinates whose gradient depends on x[block]
+    return self.cache.coupled(block)
+
   def g_func(self, x, A, b, block=None):
     # Least squares function
-    b_pred = np.dot(A, x)
+    b_pred = self.cache.product(x)
     residual = b_pred - b
     
     if block is None:
-      grad = np.dot(A.T, residual)
+      grad = A.T.dot(residual)
 
       grad += self.L2 * x
       grad += self.L1
@@ -148,17 +422,17 @@ class Least_Square_L1_NN:
     #b_pred = np.dot(A, x)
 
     if block is None:
-      hessian = np.dot(A.T, A)
+      hessian = gram(A)
       hessian += self.L2 * np.identity(self.n_params)
       
     elif block.size == 1:
       #import ipdb; ipdb.set_trace()
-      hessian = np.sum(A[:, block[0]]**2)      
+      hessian = column_power_sums(A[:, block], 2)[0]
       hessian += self.L2
       
     else:
       # Block case
-      hessian = np.dot(A[:, block].T, A[:, block])
+      hessian = gram(A[:, block])
       hessian += self.L2 * np.identity(block.size)
 
     return hessian 
@@ -166,26 +440,54 @@ class Least_Square_L1_NN:
   def Lb_func(self, x, A, b, block=None):
     # Least squares function
     if block is None:
-      E = np.linalg.eig(A.T.dot(A))[0]
+      E = np.linalg.eig(gram(A))[0]
       L_block = np.max(E) + self.L2
     else:
       A_b = A[:, block]
 
-      E = np.linalg.eig(A_b.T.dot(A_b))[0]
+      E = np.linalg.eig(gram(A_b))[0]
       L_block = np.max(E) + self.L2
     
     return L_block
 
+  def Lb_batch(self, x, A, b, blocks):
+    # Lb_func of every row of blocks
+    E = np.linalg.eigvalsh(block_grams(A, blocks))
+
+    return E[:, -1] + self.L2
+
   def Hb_func(self, x, A, b, block=None):
     if block is None:
-      L_block = np.dot(A.T, A)
+      L_block = gram(A)
       L_block += self.L2 * np.identity(self.n_params)
     else:
       A_b = A[:, block]
-      L_block = A_b.T.dot(A_b) + self.L2 * np.identity(block.size)
+      L_block = gram(A_b) + self.L2 * np.identity(block.size)
     
     return L_block
 
+  def Hb_batch(self, x, A, b, blocks):
+    # Hb_func of every row of blocks, stacked
+    return block_grams(A, blocks) + self.L2 * np.identity(blocks.shape[1])
+
+  def Hb_full_blocks(self, x, A, b, blocks):
+    # Blocks of Hb_func(block=None), the same as Hb_batch here
+    return self.Hb_batch(x, A, b, blocks)
+
+  def Hb_operator(self, x, A, b):
+    # Hb_func(block=None) as v -> A^T (A v) + L2 v
+    matvec = lambda v: A.T.dot(A.dot(v)) + self.L2 * v
+
+    return LinearOperator((self.n_params, self.n_params), matvec=matvec,
+                          rmatvec=matvec, dtype=float)
+
+  def Hb_abs_rowsum(self, x, A, b):
+    # Bound on np.sum(np.abs(Hb_func(block=None)), 1) that does not form Hb
+    if self.Hb_rowsum is None:
+      self.Hb_rowsum = abs_gram_rowsum(A) + self.L2
+
+    return self.Hb_rowsum
+
 ###########################
 # 2. LOGISTIC
 ###########################
@@ -195,37 +497,76 @@ class Logistic:
     self.L2 = args["L2"]
     self.n_params = A.shape[1]
 
-    self.lipschitz = 0.25 * np.sum(A ** 2, axis=0) + self.L2
+    self.lipschitz = 0.25 * column_power_sums(A, 2) + self.L2
+    self.Hb_rowsum = None
 
     # Mipschitz
 
     constant = (1. / (6. * np.sqrt(3))) 
 
-    # correct 
-    self.mipschitz  = np.sum(np.abs(b**3 * (A ** 3).T)  * constant, axis=1)
+    # correct: sum_i |b_i|^3 |A_ij|^3
+    A3 = abs(A).power(3) if sparse.issparse(A) else np.abs(A) ** 3
+    self.mipschitz  = constant * A3.T.dot(np.abs(b) ** 3)
+
+    # Margins b*Ax are patched after every block update and the
+    # sigmoid values are kept for the committed iterate
+    self.cache = MatvecCache(A)
+    self.sig_Ax = None
+    self.sig = None
+
+  def commit(self, x):
+    self.cache.commit(x)
 
+  def margins(self, x, b):
+    return b * self.cache.product(x)
 
+  def sigmoid(self, x, b):
+    # sigma(b * Ax), reused as long as x is the committed iterate
+    Ax = self.cache.product(x)
+    if Ax is self.sig_Ax:
+      return self.sig
+
+    sig = 1. / (1. + np.exp(- b * Ax))
+
+    if Ax is self.cache.Ax:
+      self.sig_Ax = Ax
+      self.sig = sig
+
+    return sig
 
   def f_func(self, x, A, b):
     # Logistic function
     reg = 0.5 * self.L2 * np.sum(x ** 2) 
 
-    b_pred = np.dot(A, x) 
-    agree = - b*b_pred
-    zeros = np.zeros(A.shape[0])
+    # log(1 + exp(- b * Ax))
+    loss = np.logaddexp(0, - self.margins(x, b))
+
+    return loss.sum() + reg
+
+  def f_delta(self, x, changed, delta, A, b):
+    # f(x) - f(x_old), summed over the rows whose margins changed
+    u = b * A[:, changed].dot(delta)
+    rows = np.flatnonzero(u)
 
-    loss = logsumexp(np.stack([zeros, agree], axis=1), axis=1)
-    #loss2 = np.sum(np.log(1 + np.exp(- b*b_pred))) + reg
+    m = self.margins(x, b)[rows]
+    loss = np.logaddexp(0, - m) - np.logaddexp(0, - (m - u[rows]))
+
+    x_old = x[changed] - delta
+    reg = 0.5 * self.L2 * np.sum(x[changed] ** 2 - x_old ** 2)
 
     return loss.sum() + reg
 
+  def coupled(self, A, block):
+    # Coordinates whose gradient depends on x[block]
+    return self.cache.coupled(block)
+
   def g_func(self, x, A, b, block=None):
     # Logistic function
-    b_pred = np.dot(A, x)
-    residual = - b / (1 + np.exp(b * b_pred))
+    sig = self.sigmoid(x, b)
+    residual = - b * (1. - sig)
     
     if block is None:
-      grad = np.dot(A.T, residual)
+      grad = A.T.dot(residual)
 
       grad +=self.L2 * x
     else:
@@ -236,24 +577,20 @@ class Logistic:
 
   def h_func(self, x, A, b, block=None):
     # Logistic function
-    b_pred = np.dot(A, x)
-
-    sig = 1. / (1. + np.exp(- b * b_pred))
+    sig = self.sigmoid(x, b)
+    p = sig * (1 - sig)
 
     if block is None:
-      S = np.diag(sig * (1-sig))
-      hessian = np.dot(A.T, S).dot(A)
+      hessian = gram(A, p)
       hessian += self.L2 * np.identity(x.size)
       
     elif block.size == 1:
-      #import ipdb; ipdb.set_trace()
-      hessian = np.sum(A[:, block[0]]**2 * sig * (1-sig))      
+      hessian = gram(A[:, block], p)[0, 0]
       hessian += self.L2
       
     else:
       # Block case
-      p = np.diag(sig * (1- sig))
-      hessian = A[:, block].T.dot(p).dot(A[:, block])
+      hessian = gram(A[:, block], p)
       hessian +=self.L2 * np.identity(block.size)
 
     return hessian 
@@ -265,26 +602,54 @@ class Logistic:
     else:
       A_b = A[:, block]
 
-    E = np.linalg.eig(A_b.T.dot(A_b))[0]
+    E = np.linalg.eig(gram(A_b))[0]
     L_block = 0.25 * np.max(E) + self.L2
     
     return L_block
 
+  def Lb_batch(self, x, A, b, blocks):
+    # Lb_func of every row of blocks
+    E = np.linalg.eigvalsh(block_grams(A, blocks))
+
+    return 0.25 * E[:, -1] + self.L2
+
 
   def Hb_func(self, x, A, b, block=None):
     # Logistic function
     if block is None:
       A_b = A
 
-      L_block = 0.25 * A_b.T.dot(A_b) + self.L2
+      L_block = 0.25 * gram(A_b) + self.L2
     
     else:
       A_b = A[:, block]
 
-      L_block = 0.25 * A_b.T.dot(A_b) + self.L2
+      L_block = 0.25 * gram(A_b) + self.L2
     
     return L_block
 
+  def Hb_batch(self, x, A, b, blocks):
+    # Hb_func of every row of blocks, stacked
+    return 0.25 * block_grams(A, blocks) + self.L2
+
+  def Hb_full_blocks(self, x, A, b, blocks):
+    # Blocks of Hb_func(block=None), the same as Hb_batch here
+    return self.Hb_batch(x, A, b, blocks)
+
+  def Hb_operator(self, x, A, b):
+    # Hb_func(block=None) as v -> 0.25 A^T (A v) + L2 sum(v)
+    matvec = lambda v: 0.25 * A.T.dot(A.dot(v)) + self.L2 * np.sum(v)
+
+    return LinearOperator((self.n_params, self.n_params), matvec=matvec,
+                          rmatvec=matvec, dtype=float)
+
+  def Hb_abs_rowsum(self, x, A, b):
+    # Bound on np.sum(np.abs(Hb_func(block=None)), 1) that does not form Hb
+    if self.Hb_rowsum is None:
+      self.Hb_rowsum = 0.25 * abs_gram_rowsum(A) + self.n_params * self.L2
+
+    return self.Hb_rowsum
+
 ###########################
 # 2. Softmax
 ###########################
@@ -298,8 +663,9 @@ class Softmax:
     self.n_classes = b.shape[1]
 
     self.lipschitz = (np.ones((self.n_classes, 1)) * 0.25 * 
-                      np.sum(A ** 2, axis=0) + self.L2).T
+                      column_power_sums(A, 2) + self.L2).T
     self.lipschitz = self.lipschitz.ravel()
+    self.Hb_rowsum = None
 
     # Mipschitz
     sigma = (np.sqrt(3.) + 3.)/6.
@@ -307,10 +673,17 @@ class Softmax:
       
 
     self.mipschitz =  (np.ones((self.n_classes, 1)) * 
-                        np.sum(np.abs(constant * A ** 3), axis=0)).T
+                        np.abs(constant) * column_power_sums(A, 3)).T
 
     self.mipschitz = self.mipschitz.ravel()
 
+    # The logits Ax are patched after every block update. The row
+    # normalizers are kept as the row maxima M and the sums
+    # S = sum_c exp(Ax - M), which only change in the updated classes
+    self.cache = MatvecCache(A)
+    self.norm_Ax = None
+    self.norm_max = None
+    self.norm_sum = None
 
 
   def base(self, x, block):
@@ -328,15 +701,81 @@ class Softmax:
 
     return x, block
 
+  def commit(self, x):
+    # Softmax function
+    x, _ = self.base(x, block=None)
+    old_Ax = self.cache.Ax
+    changed = self.cache.commit(x)
+
+    norms = None
+    if changed is not None and old_Ax is self.norm_Ax:
+      norms = self.correct_normalizers(self.cache.Ax, changed)
+
+    if norms is None:
+      self.norm_Ax = None
+    else:
+      self.norm_Ax = self.cache.Ax
+      self.norm_max, self.norm_sum = norms
+
+  def correct_normalizers(self, logits, changed):
+    # Update the committed normalizers in the classes that changed, or
+    # return None if that would overflow or lose precision
+    classes = np.unique(changed % self.n_classes)
+    M = self.norm_max[:, np.newaxis]
+
+    new = logits[:, classes] - M
+    if classes.size > 0 and new.max() > 30:
+      return None
+
+    old = self.norm_Ax[:, classes] - M
+    S = self.norm_sum + np.exp(new).sum(axis=1) - np.exp(old).sum(axis=1)
+
+    if np.any(S < 1e-4 * self.norm_sum):
+      return None
+
+    return self.norm_max, S
+
+  def normalizers(self, x):
+    # Softmax function
+    logits, changed = self.cache.patched(x)
+
+    if logits is self.norm_Ax:
+      return logits, self.norm_max, self.norm_sum
+
+    norms = None
+    if changed is not None and self.norm_Ax is self.cache.Ax:
+      norms = self.correct_normalizers(logits, changed)
+
+    if norms is None:
+      M = logits.max(axis=1)
+      S = np.exp(logits - M[:, np.newaxis]).sum(axis=1)
+    else:
+      M, S = norms
+
+    if logits is self.cache.Ax:
+      self.norm_Ax = logits
+      self.norm_max, self.norm_sum = M, S
+
+    return logits, M, S
+
+  def probabilities(self, x, classes=None):
+    # Softmax function
+    logits, M, S = self.normalizers(x)
+
+    if classes is not None:
+      logits = logits[:, classes]
+
+    return np.exp(logits - M[:, np.newaxis]) / S[:, np.newaxis]
+
   def f_func(self, x, A, b):
     # Softmax function
     x, block = self.base(x, block=None)
 
-    b_pred = np.dot(A, x)
+    b_pred, M, S = self.normalizers(x)
     # loss = - np.sum(b * np.log(softmax(b_pred)))
 
     # Add normalizing factors
-    loss = np.sum(logsumexp(b_pred, axis=1))
+    loss = np.sum(M + np.log(S))
     # Add dot products
     loss -= np.sum(b_pred * b)
     # Add regualization
@@ -345,70 +784,87 @@ class Softmax:
 
     return loss
 
+  def f_delta(self, x, changed, delta, A, b):
+    # f(x) - f(x_old), recomputing the normalizers of x_old
+    # only in the classes that changed
+    x, _ = self.base(x, block=None)
+    logits, M, S = self.normalizers(x)
+
+    features, classes = np.unravel_index(changed, x.shape)
+    C, c_ind = np.unique(classes, return_inverse=True)
+
+    D = np.zeros((self.n_features, C.size))
+    np.add.at(D, (features, c_ind), delta)
+    U = np.unique(features)
+    u = A[:, U].dot(D[U])
+
+    new = logits[:, C] - M[:, np.newaxis]
+    old = new - u
+    S_old = S - np.exp(new).sum(axis=1) + np.exp(old).sum(axis=1)
+
+    loss = np.sum(np.log(S) - np.log(S_old))
+    loss -= np.sum(b[:, C] * u)
+
+    x_old = x[features, classes] - delta
+    reg = 0.5 * self.L2 * np.sum(x[features, classes] ** 2 - x_old ** 2)
+
+    return loss + reg
+
+  def coupled(self, A, block):
+    # Coordinates whose gradient depends on x[block]: every class of
+    # the features that share rows with the block, since the
+    # normalizers of those rows change
+    features = self.cache.coupled(np.unique(block // self.n_classes))
+    classes = np.arange(self.n_classes)
+
+    return (features[:, np.newaxis] * self.n_classes + classes).ravel()
+
   def g_func(self, x, A, b, block=None):
     # Softmax function
     x, block = self.base(x, block)
-    b_pred = np.dot(A, x)
-    R = softmax(b_pred) - b
 
     if block is None:
-        grad = np.dot(A.T, R)
+        R = self.probabilities(x) - b
+        grad = A.T.dot(R)
         grad += self.L2 * x
 
     else:
         features, classes = block
+        R = self.probabilities(x, classes) - b[:, classes]
         # GET THE DIAGONAL OF THE DOT PRODUCT
-        grad = np.einsum('ij,ij->i', A.T[features], R[:, classes].T)
+        grad = np.einsum('ij,ij->j', columns(A, features), R)
         grad += self.L2 * x[block]
 
-        # features, classes = block
-
-        # grad = np.dot(A[:, features].T, 
-        #               softmax(b_pred)[:, classes] - b[:, classes])
-
-        # grad += (L2 *  x[features, classes])
-
     return grad.ravel()
 
   def h_func(self, x, A, b, block=None):
     # Softmax function
     x, block = self.base(x, block)
-    b_pred = np.dot(A, x)
 
     if block == None:
       qweqwe
       block = np.arange(x.size)
       block = np.unravel_index(block,  (self.n_features, self.n_classes))
 
+    features, classes = block
+    soft = self.probabilities(x, classes)
+
     if block[0].size == 1:
         # One coordinate
-        features, classes = block
-        #import pdb;pdb.set_trace()
-        soft = softmax(b_pred)[:, classes]
-
-        h = np.sum(A[:, features]**2 * soft * (1-soft))
+        h = gram(A[:, features], (soft * (1-soft)).ravel())[0, 0]
         h += self.L2
 
     else:
 
       # Block Coordinate
-      features, classes = block
-      soft = softmax(b_pred)
-
       block_size = features.size
 
-      h = np.zeros((block_size, block_size))
-      for i, (f1, c1) in enumerate(zip(features, classes)):
-        for j, (f2, c2) in enumerate(zip(features, classes)):
-          # Class sigmoid 
-          if c1 == c2:
-            sig = soft[:, c1]
-            S = sig * (1-sig)
-          else:
-            S = -soft[:, c1] * soft[:,c2]
+      # h[i, j] = sum_n A[n, f_i] A[n, f_j] (1{c_i = c_j} p_ci - p_ci p_cj)
+      A_b = columns(A, features)
+      AP = A_b * soft
+      same_class = (classes[:, np.newaxis] == classes[np.newaxis, :])
 
-          # Feature
-          h[i, j] = np.dot(S, A[:, f1]* A[:, f2])
+      h = np.dot(A_b.T, AP) * same_class - np.dot(AP.T, AP)
 
       h += self.L2 * np.identity(block_size)  
 
@@ -425,6 +881,63 @@ class Softmax:
     
     return L_block
 
+  def Lb_batch(self, x, A, b, blocks):
+    # Lb_func of every row of blocks
+    E = np.linalg.eigvalsh(self.Hb_batch(x, A, b, blocks))
+
+    return E[:, -1] + self.L2
+
+  def Hb_batch(self, x, A, b, blocks):
+    # Hb_func of every row of blocks; like Hb_func, each block is
+    # bounded with the k classes it touches (plus one)
+    classes = blocks % self.n_classes
+    sorted_classes = np.sort(classes, axis=1)
+    n_unique = 1 + np.sum(np.diff(sorted_classes, axis=1) != 0, axis=1)
+    k = np.minimum(self.n_classes, n_unique + 1)[:, np.newaxis, np.newaxis]
+
+    return self.class_bound_blocks(A, blocks, k)
+
+  def Hb_full_blocks(self, x, A, b, blocks):
+    # Blocks of Hb_func(block=None), which uses k = n_classes
+    return self.class_bound_blocks(A, blocks, self.n_classes)
+
+  def class_bound_blocks(self, A, blocks, k):
+    # The bounds s(c1, c2) * (A^T A)[f1, f2] of all blocks formed at once
+    features, classes = np.divmod(blocks, self.n_classes)
+    Z = block_grams(A, features)
+
+    same = classes[:, :, np.newaxis] == classes[:, np.newaxis, :]
+    Hb = 0.5 * (same - 1. / k) * Z
+    if self.L2:
+      Hb += self.L2 * np.identity(blocks.shape[1])
+
+    return Hb
+
+  def Hb_operator(self, x, A, b):
+    # Hb_func(block=None) is the Kronecker product (A^T A) x S with
+    # S = 0.5 (I - 11^T / k), so Hb v = A^T (A V) S + L2 v
+    k = self.n_classes
+    S = 0.5 * (np.identity(k) - 1. / k)
+
+    def matvec(v):
+      V = np.reshape(v, (self.n_features, k))
+      Hv = A.T.dot(A.dot(V)).dot(S)
+
+      return Hv.ravel() + self.L2 * V.ravel()
+
+    return LinearOperator((self.n_params, self.n_params), matvec=matvec,
+                          rmatvec=matvec, dtype=float)
+
+  def Hb_abs_rowsum(self, x, A, b):
+    # Bound on np.sum(np.abs(Hb_func(block=None)), 1) that does not form
+    # Hb; every row of S = 0.5 (I - 11^T / k) has absolute sum (k - 1) / k
+    if self.Hb_rowsum is None:
+      k = self.n_classes
+      rowsum = (k - 1.) / k * abs_gram_rowsum(A)
+      self.Hb_rowsum = np.repeat(rowsum, k) + self.L2
+
+    return self.Hb_rowsum
+
 
   def Hb_func(self, x, A, b, block=None):
     # Softmax function
@@ -444,14 +957,13 @@ class Softmax:
       n, d = A.shape
       k = b.shape[1]
       
-      Hb = computeFull_Hb(A, d, k, features, classes)
+      Hb = computeFull_Hb(gram(A), d, k, features, classes)
     else:
       U = np.unique(features)
       Umap = {u:i for i, u in enumerate(U)}
       k = min(n_classes, np.unique(classes).size + 1)
           
-      Z = A[:, U]
-      Z = Z.T.dot(Z)
+      Z = gram(A[:, U])
 
 
       Hb = np.zeros((block_size, block_size))
@@ -483,8 +995,7 @@ def softmax(X):
     return X
 
 @jit
-def computeFull_Hb(A, d, k, features, classes):
-  AA = A.T.dot(A)
+def computeFull_Hb(AA, d, k, features, classes):
   Hb = np.zeros((d*k, d*k))
 
   for i in range(d*k):
@@ -514,40 +1025,53 @@ class BeliefPropagation:
     self.L2 = args["L2"]
     self.n_params = A.shape[1]
 
-    self.lipschitz = np.diag(A) + self.L2
+    self.lipschitz = A.diagonal() + self.L2
+    self.Hb_rowsum = None
+
+    # Ax is patched after every bpExact/bpGabp update so that
+    # block gradients only read the rows (Ax - b)[block]
+    self.cache = MatvecCache(A)
+
+  def commit(self, x):
+    self.cache.commit(x)
 
   def f_func(self, x, A, b):
     # BeliefPropagation
     reg = 0.5 * self.L2 * np.sum(x ** 2)
       
-    loss = 0.5 * x.T.dot(A).dot(x)
+    loss = 0.5 * x.dot(self.cache.product(x))
     loss -= np.dot(b, x)
     loss += reg
 
     return loss
 
+  def f_delta(self, x, changed, delta, A, b):
+    # f(x) - f(x_old) = delta^T (Ax)_c - 0.5 delta^T A_cc delta - b_c^T delta
+    Ax_c = self.cache.rows(x, changed)
+    A_cc = A[np.ix_(changed, changed)]
+
+    loss = delta.dot(Ax_c) - 0.5 * delta.dot(A_cc.dot(delta))
+    loss -= np.dot(b[changed], delta)
+
+    x_old = x[changed] - delta
+    loss += 0.5 * self.L2 * np.sum(x[changed] ** 2 - x_old ** 2)
+
+    return loss
+
+  def coupled(self, A, block):
+    # Coordinates whose gradient depends on x[block]
+    return np.union1d(self.cache.neighbors(block), block)
+
   def g_func(self, x, A, b, block=None):
     # BeliefPropagation
     L2 = self.L2
     
     if block is None:
-      grad = np.dot(x.T, A) - b
+      grad = self.cache.product(x) - b
       grad += L2 * x
       
     else:
-      all_indices = np.arange(self.n_params)
-    
-      block_indices = block
-      non_block_indices = np.delete(all_indices, block_indices)
-    
-      A_bc = A[block_indices][:, non_block_indices]
-      A_bb = A[block_indices][:, block_indices]
-      
-      y_prime = A_bc.dot(x[non_block_indices]) - b[block_indices]
-      X_prime = np.dot(A_bb, x[block_indices])
-      grad = X_prime + y_prime
-      
-      
+      grad = self.cache.rows(x, block) - b[block]
       grad += (L2 *  x[block])
 
     return grad
@@ -556,9 +1080,9 @@ class BeliefPropagation:
     # BeliefPropagation
     """dual hess"""
     if block is None:
-      return A + self.L2 * np.identity(self.n_params)
+      return dense(A) + self.L2 * np.identity(self.n_params)
     else:
-      return A[block][:, block] + self.L2 * np.identity(block.size)
+      return dense(A[block][:, block]) + self.L2 * np.identity(block.size)
 
 
   def Lb_func(self, x, A, b, block=None):
@@ -568,11 +1092,17 @@ class BeliefPropagation:
     else:
       A_b = A[block][:, block]
 
-    E = np.linalg.eigh(A_b)[0]
+    E = np.linalg.eigh(dense(A_b))[0]
     L_block = np.max(E) + self.L2
     
     return L_block
 
+  def Lb_batch(self, x, A, b, blocks):
+    # Lb_func of every row of blocks
+    E = np.linalg.eigvalsh(block_submatrices(A, blocks))
+
+    return E[:, -1] + self.L2
+
   def Hb_func(self, x, A, b, block=None):
     # BeliefPropagation
 
@@ -581,10 +1111,95 @@ class BeliefPropagation:
     else:
       A_b = A[block][:, block]
 
-    L_block = A_b + self.L2
+    L_block = dense(A_b) + self.L2
     
     return L_block
 
+  def Hb_batch(self, x, A, b, blocks):
+    # Hb_func of every row of blocks, stacked
+    return block_submatrices(A, blocks) + self.L2
+
+  def Hb_full_blocks(self, x, A, b, blocks):
+    # Blocks of Hb_func(block=None), the same as Hb_batch here
+    return self.Hb_batch(x, A, b, blocks)
+
+  def Hb_operator(self, x, A, b):
+    # Hb_func(block=None) as v -> A v + L2 sum(v)
+    matvec = lambda v: A.dot(v) + self.L2 * np.sum(v)
+
+    return LinearOperator((self.n_params, self.n_params), matvec=matvec,
+                          rmatvec=matvec, dtype=float)
+
+  def Hb_abs_rowsum(self, x, A, b):
+    # np.sum(np.abs(Hb_func(block=None)), 1), where the entries outside
+    # the sparsity of A are all equal to L2
+    if self.Hb_rowsum is None:
+      if sparse.issparse(A):
+        A = sparse.csr_matrix(A)
+        shifted = A.copy()
+        shifted.data = np.abs(shifted.data + self.L2)
+        nnz = np.diff(A.indptr)
+        rowsum = np.asarray(shifted.sum(axis=1)).ravel()
+        rowsum += (A.shape[1] - nnz) * abs(self.L2)
+      else:
+        rowsum = np.sum(np.abs(A + self.L2), 1)
+
+      self.Hb_rowsum = rowsum
+
+    return self.Hb_rowsum
+
+
+###########################
+# 3. Label propagation graph edges
+###########################
+class LabelPropEdges:
+  """Edges of a label propagation graph with weights W and labels y.
+
+  The unlabeled-unlabeled (UU) and unlabeled-labeled (UL) parts of W are
+  extracted once as CSR matrices whose rows are the unlabeled nodes, so
+  that losses over the edges cost O(|E|), or O(|block| * degree) for the
+  rows of a block.
+  """
+  def __init__(self, W, y, unlabeled, labeled):
+    W = sparse.csr_matrix(W, dtype=float)
+    nodes = np.arange(W.shape[0])
+    U = nodes[unlabeled]
+    L = nodes[labeled]
+
+    self.W_UU = W[U][:, U].tocsr()
+    self.W_UL = W[U][:, L].tocsr()
+    self.y_L = np.asarray(y, dtype=float).ravel()[L]
+
+    self.n_nodes = U.size
+
+    # Position of each unlabeled node in the current block (-1 if absent)
+    self.position = np.full(U.size, -1)
+
+  def rows(self, M, block=None):
+    """Returns (local, cols, weights) for the entries of the rows `block`
+    of the CSR matrix M, where local indexes into block."""
+    if block is None:
+      local = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+      return local, M.indices, M.data
+
+    starts = M.indptr[block]
+    counts = M.indptr[block + 1] - starts
+
+    local = np.repeat(np.arange(block.size), counts)
+    offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    entries = np.arange(counts.sum()) + offsets
+
+    return local, M.indices[entries], M.data[entries]
+
+  def within_block(self, local, cols, block):
+    """Returns the block positions of cols and a mask of the entries
+    whose column also lies in the block."""
+    self.position[block] = np.arange(block.size)
+    pos = self.position[cols]
+    self.position[block] = -1
+
+    return pos, pos >= 0
+
 
 ###########################
 # 3. Belief Propagation with Huber loss
@@ -593,15 +1208,18 @@ class BeliefPropagation_Huber:
   def __init__(self, A, b, args):
     self.ylabel = "bp huber"
     self.n_params = A.shape[1]
-    self.W = args["data_W"]
-    self.y = args["data_y"]
     self.unlabeled_indices = args["unlabeled"]
     self.labeled_indices = args["labeled"]
     self.eps = 1.0
 
     self.L2 = args["L2"]
     self.n_params = A.shape[1]
-    self.lipschitz = np.diag(A) + self.L2
+    self.lipschitz = A.diagonal() + self.L2
+    self.Hb_rowsum = None
+
+    # Evaluate the loss over the UU and UL edges only
+    self.edges = LabelPropEdges(args["data_W"], args["data_y"],
+                                self.unlabeled_indices, self.labeled_indices)
 
   
   def huber(self, z):
@@ -616,103 +1234,73 @@ class BeliefPropagation_Huber:
     return np.where(np.abs(z)<=self.eps, 1, 0)
 
 
-  def pairwise_differences(self, x, y):
-    return np.expand_dims(x,1)-y
-
-
   def f_func(self, ybar, A=None, b=None):
+    E = self.edges
+
     # Unlabeled
-    W_UU = self.W[self.unlabeled_indices][:,self.unlabeled_indices]
-    z = self.pairwise_differences(ybar, ybar)
-    z = W_UU * self.huber(z)
-    loss = np.sum(z)
+    rows, cols, w = E.rows(E.W_UU)
+    loss = np.sum(w * self.huber(ybar[rows] - ybar[cols]))
 
     # Labeled
-    W_UL = self.W[self.unlabeled_indices][:,self.labeled_indices]
-    ylabled = self.y[self.labeled_indices]
-    z = self.pairwise_differences(ybar, ylabled)
-    z = W_UL * self.huber(z)
-    loss += np.sum(z)
+    rows, cols, w = E.rows(E.W_UL)
+    loss += np.sum(w * self.huber(ybar[rows] - E.y_L[cols]))
 
     # Regularization
     loss += 0.5 * self.L2 * np.sum(ybar**2)
 
     return loss
 
+  def coupled(self, A, block):
+    # Coordinates whose gradient depends on x[block]
+    neighbors = self.edges.rows(self.edges.W_UU, block)[1]
+
+    return np.union1d(neighbors, block)
+
   def g_func(self, ybar, A=None, b=None, block=None):
-    if block is None:
-      # Unlabeled
-      W_UU = self.W[self.unlabeled_indices][:,self.unlabeled_indices]
-      z = self.pairwise_differences(ybar, ybar)
-      grad = 2*np.sum(W_UU*self.huber_p(z), axis=1)
-      grad -= 3*np.diag(W_UU)*self.huber_p(np.diag(z))
-
-      # Labeled
-      W_UL = self.W[self.unlabeled_indices][:,self.labeled_indices]
-      ylabled = self.y[self.labeled_indices]
-      z = self.pairwise_differences(ybar, ylabled)
-      grad += np.sum(W_UL*self.huber_p(z), axis=1)
-
-      # Regularization
-      grad += (self.L2*ybar)
-
-    else:    
-      # Unlabeled
-      W_UU = self.W[self.unlabeled_indices][:,self.unlabeled_indices]
-      W_UB = W_UU[block, :]
-      z = self.pairwise_differences(ybar[block], ybar)
-      grad = 2*np.sum(W_UB*self.huber_p(z), axis=1)
-      grad -= 3*np.diag(W_UB)*self.huber_p(np.diag(z))
-
-      # Labeled
-      W_UL = self.W[self.unlabeled_indices][:,self.labeled_indices]
-      W_BL = W_UL[block, :]
-      ylabled = self.y[self.labeled_indices]
-      z = self.pairwise_differences(ybar[block], ylabled)
-      grad += np.sum(W_BL*self.huber_p(z), axis=1)
-
-      # Regularization
-      grad += (self.L2 * ybar[block])
+    E = self.edges
+    ybar_b = ybar if block is None else ybar[block]
+    n_rows = ybar_b.size
+
+    # Unlabeled
+    local, cols, w = E.rows(E.W_UU, block)
+    z = ybar_b[local] - ybar[cols]
+    grad = 2*np.bincount(local, w*self.huber_p(z), minlength=n_rows)
+
+    # Labeled
+    local, cols, w = E.rows(E.W_UL, block)
+    z = ybar_b[local] - E.y_L[cols]
+    grad += np.bincount(local, w*self.huber_p(z), minlength=n_rows)
+
+    # Regularization
+    grad += (self.L2 * ybar_b)
 
     return grad
 
   def h_func(self, ybar, A, b, block=None):
+    E = self.edges
     if block is None:
-      # Unlabeled
-      W_UU = self.W[self.unlabeled_indices][:,self.unlabeled_indices]
-      z = self.pairwise_differences(ybar, ybar)
-      hpp = self.huber_pp(z)
-      Z = W_UU*hpp      
-      h = -2*Z + np.diag(2*np.sum(Z, axis=1)+np.diag(Z))
-
-      # Labeled
-      W_UL = self.W[self.unlabeled_indices][:,self.labeled_indices]
-      ylabled = self.y[self.labeled_indices]
-      z = self.pairwise_differences(ybar, ylabled)
-      hpp = self.huber_pp(z)
-      h += np.diag(np.sum(W_UL*hpp, axis=1))
-
-      # Regularization
-      h += self.L2 * np.identity(len(ybar))
+      block = np.arange(E.n_nodes)
 
-    else:
-      # Unlabeled
-      W_UU = self.W[self.unlabeled_indices][:,self.unlabeled_indices]
-      W_UB = W_UU[block, :]
-      z = self.pairwise_differences(ybar[block], ybar)
-      Z = W_UB[:,block]*self.huber_pp(z[:,block])
-      h = -2*Z + np.diag(2*np.sum(W_UB*self.huber_pp(z), axis=1)+np.diag(Z))
-
-      # Labeled
-      W_UL = self.W[self.unlabeled_indices][:,self.labeled_indices]
-      W_BL = W_UL[block,:]
-      ylabled = self.y[self.labeled_indices]
-      z = self.pairwise_differences(ybar[block], ylabled)
-      hpp = self.huber_pp(z)
-      h += np.diag(np.sum(W_BL*hpp, axis=1))
-
-      # Regularization
-      h += self.L2 * np.identity(len(block))
+    ybar_b = ybar[block]
+    n_rows = block.size
+
+    # Unlabeled: -2 W_ij h''(y_i - y_j) off the diagonal and
+    # 2 sum_j W_ij h''(y_i - y_j) on the diagonal
+    local, cols, w = E.rows(E.W_UU, block)
+    Z = w*self.huber_pp(ybar_b[local] - ybar[cols])
+    pos, inside = E.within_block(local, cols, block)
+
+    h = np.zeros((n_rows, n_rows))
+    h[local[inside], pos[inside]] = -2*Z[inside]
+    diag = 2*np.bincount(local, Z, minlength=n_rows)
+
+    # Labeled
+    local, cols, w = E.rows(E.W_UL, block)
+    hpp = self.huber_pp(ybar_b[local] - E.y_L[cols])
+    diag += np.bincount(local, w*hpp, minlength=n_rows)
+
+    # Regularization
+    h[np.diag_indices(n_rows)] += diag + self.L2
 
     return h
 
@@ -723,15 +1311,42 @@ class BeliefPropagation_Huber:
     else:
       A_b = A[block][:, block]
 
-    E = np.linalg.eigh(A_b)[0]
+    E = np.linalg.eigh(dense(A_b))[0]
     L_block = np.max(E) + self.L2
     
     return L_block
 
+  def Lb_batch(self, x, A, b, blocks):
+    # Lb_func of every row of blocks
+    E = np.linalg.eigvalsh(block_submatrices(A, blocks))
+
+    return E[:, -1] + self.L2
+
   def Hb_func(self, x, A, b, block=None):
     # BeliefPropagation
     return self.h_func(x, A, b, block)
 
+  def Hb_batch(self, x, A, b, blocks):
+    # Hb_func of every row of blocks, stacked
+    return np.array([self.h_func(x, A, b, block) for block in blocks])
+
+  def Hb_full_blocks(self, x, A, b, blocks):
+    # Blocks of Hb_func(block=None), the same as Hb_batch here
+    return self.Hb_batch(x, A, b, blocks)
+
+  def Hb_operator(self, x, A, b):
+    # Hb_func(block=None), whose edge terms are formed once
+    H = self.h_func(x, A, b)
+
+    return LinearOperator(H.shape, matvec=H.dot, rmatvec=H.dot, dtype=float)
+
+  def Hb_abs_rowsum(self, x, A, b):
+    # np.sum(np.abs(Hb_func(block=None)), 1) at the first x it is asked for
+    if self.Hb_rowsum is None:
+      self.Hb_rowsum = np.sum(np.abs(self.Hb_func(x, A, b)), 1)
+
+    return self.Hb_rowsum
+
 
 ###########################
 # 4. Belief Propagation with Logistic loss
@@ -740,8 +1355,6 @@ class BeliefPropagation_Logistic:
   def __init__(self, A, b, args):
     self.ylabel = "bp logistic"
     self.n_params = A.shape[1]
-    self.W = args["data_W"]
-    self.y = args["data_y"]
     self.unlabeled_indices = args["unlabeled"]
     self.labeled_indices = args["labeled"]
 
@@ -749,12 +1362,17 @@ class BeliefPropagation_Logistic:
     self.L2 = 1e-3 if args["L2"] == 0 else args["L2"]
     self.n_params = A.shape[1]
 
-    self.lipschitz = np.diag(A) + self.L2
+    self.lipschitz = A.diagonal() + self.L2
+    self.Hb_rowsum = None
+
+    # Evaluate the loss over the UU and UL edges only
+    self.edges = LabelPropEdges(args["data_W"], args["data_y"],
+                                self.unlabeled_indices, self.labeled_indices)
 
   
   def logistic(self, z):
-    zeros = np.zeros(z.shape)
-    return logsumexp(np.stack([zeros, z], axis=2), axis=2)
+    # log(1 + exp(z))
+    return np.logaddexp(0, z)
 
 
   def logistic_p(self, z):
@@ -766,112 +1384,78 @@ class BeliefPropagation_Logistic:
     return expz/((1+expz)**2)
 
 
-  def pairwise_products(self, x, y):
-    return np.expand_dims(x,1)*y
-
-
   def f_func(self, ybar, A=None, b=None):
+    E = self.edges
+
     # Unlabeled
-    W_UU = self.W[self.unlabeled_indices][:,self.unlabeled_indices]
-    z = self.pairwise_products(ybar, ybar)
-    z = W_UU * self.logistic(z)
-    loss = np.sum(z)
+    rows, cols, w = E.rows(E.W_UU)
+    loss = np.sum(w * self.logistic(ybar[rows] * ybar[cols]))
     
     # Labeled
-    W_UL = self.W[self.unlabeled_indices][:,self.labeled_indices]
-    ylabled = self.y[self.labeled_indices]
-    z = self.pairwise_products(ybar, ylabled)
-    z = W_UL * self.logistic(z)
-    loss += np.sum(z)
+    rows, cols, w = E.rows(E.W_UL)
+    loss += np.sum(w * self.logistic(ybar[rows] * E.y_L[cols]))
 
     # Regularization
     loss += 0.5 * self.L2 * np.sum(ybar**2)
 
     return loss
 
+  def coupled(self, A, block):
+    # Coordinates whose gradient depends on x[block]
+    neighbors = self.edges.rows(self.edges.W_UU, block)[1]
+
+    return np.union1d(neighbors, block)
+
   def g_func(self, ybar, A=None, b=None, block=None):
-    if block is None:
-      # Unlabeled
-      W_UU = self.W[self.unlabeled_indices][:,self.unlabeled_indices]
-      z = self.pairwise_products(ybar, ybar)
-      g = 2*np.sum(W_UU*self.logistic_p(z)*ybar, axis=1)
-      
-      # Labeled
-      W_UL = self.W[self.unlabeled_indices][:,self.labeled_indices]
-      ylabled = self.y[self.labeled_indices]
-      z = self.pairwise_products(ybar, ylabled)
-      g += np.sum(W_UL*self.logistic_p(z)*ylabled, axis=1)
-
-      # Regularization
-      g += self.L2*ybar
-
-    else:    
-      # Unlabeled
-      W_UU = self.W[self.unlabeled_indices][:,self.unlabeled_indices]
-      W_BU = W_UU[block, :]
-      ybar_b = ybar[block]
-      z = self.pairwise_products(ybar_b, ybar)
-      g = 2*np.sum(W_BU*self.logistic_p(z)*ybar, axis=1)
-
-      # Labeled
-      W_UL = self.W[self.unlabeled_indices][:,self.labeled_indices]
-      W_BL = W_UL[block, :]
-      ylabled = self.y[self.labeled_indices]
-      z = self.pairwise_products(ybar[block], ylabled)
-      g += np.sum(W_BL*self.logistic_p(z)*ylabled, axis=1)
-
-      # Regularization
-      g += (self.L2 * ybar[block])
+    E = self.edges
+    ybar_b = ybar if block is None else ybar[block]
+    n_rows = ybar_b.size
+
+    # Unlabeled
+    local, cols, w = E.rows(E.W_UU, block)
+    z = ybar_b[local] * ybar[cols]
+    g = 2*np.bincount(local, w*self.logistic_p(z)*ybar[cols], minlength=n_rows)
+
+    # Labeled
+    local, cols, w = E.rows(E.W_UL, block)
+    ylabled = E.y_L[cols]
+    z = ybar_b[local] * ylabled
+    g += np.bincount(local, w*self.logistic_p(z)*ylabled, minlength=n_rows)
+
+    # Regularization
+    g += (self.L2 * ybar_b)
 
     return g
 
   def h_func(self, ybar, A, b, block=None):
+    E = self.edges
     if block is None:
-      # Unlabeled
-      W_UU = self.W[self.unlabeled_indices][:,self.unlabeled_indices]
-      z = self.pairwise_products(ybar, ybar)
-      p = self.logistic_p(z)
-      pp = self.logistic_pp(z)
-      ybarsq = ybar**2
-      # Off-diagonals
-      h = 2*W_UU*(pp*z+p)
-      # Diagonals
-      h += np.diag(np.sum(2*W_UU*pp*ybarsq, axis=1) + np.diag(2*W_UU*pp*ybarsq+W_UU*p))
-
-      # Labeled
-      W_UL = self.W[self.unlabeled_indices][:,self.labeled_indices]
-      ylabled = self.y[self.labeled_indices]
-      z = self.pairwise_products(ybar, ylabled)
-      h += np.diag(np.sum(W_UL*self.logistic_pp(z)*(ylabled**2), axis=1))
-
-      # Regularization
-      h += self.L2 * np.identity(len(ybar))
+      block = np.arange(E.n_nodes)
 
-    else:
-      # Unlabeled
-      W_UU = self.W[self.unlabeled_indices][:,self.unlabeled_indices]
-      W_BB = W_UU[block][:,block]
-      ybar_b = ybar[block]
-      z_BU = self.pairwise_products(ybar_b, ybar)
-      z = z_BU[:,block]
-      p = self.logistic_p(z)
-      pp = self.logistic_pp(z)
-      ybarsq = ybar_b**2
-      # Off-diagonals
-      h = 2*W_BB*(pp*z+p)
-      # Diagonals
-      W_BU = W_UU[block,:]
-      h += np.diag(np.sum(2*W_BU*self.logistic_pp(z_BU)*(ybar**2), axis=1) + np.diag(2*W_BB*pp*ybarsq+W_BB*p))
-
-      # Labeled
-      W_UL = self.W[self.unlabeled_indices][:,self.labeled_indices]
-      W_BL = W_UL[block, :]
-      ylabled = self.y[self.labeled_indices]
-      z = self.pairwise_products(ybar[block], ylabled)
-      h += np.diag(np.sum(W_BL*self.logistic_pp(z)*(ylabled**2), axis=1))
-
-      # Regularization
-      h += self.L2 * np.identity(len(block))
+    ybar_b = ybar[block]
+    n_rows = block.size
+
+    # Unlabeled
+    local, cols, w = E.rows(E.W_UU, block)
+    z = ybar_b[local] * ybar[cols]
+    p = self.logistic_p(z)
+    pp = self.logistic_pp(z)
+    pos, inside = E.within_block(local, cols, block)
+
+    # Off-diagonals
+    h = np.zeros((n_rows, n_rows))
+    h[local[inside], pos[inside]] = (2*w*(pp*z+p))[inside]
+    # Diagonals
+    diag = np.bincount(local, 2*w*pp*(ybar[cols]**2), minlength=n_rows)
+
+    # Labeled
+    local, cols, w = E.rows(E.W_UL, block)
+    ylabled = E.y_L[cols]
+    z = ybar_b[local] * ylabled
+    diag += np.bincount(local, w*self.logistic_pp(z)*(ylabled**2), minlength=n_rows)
+
+    # Regularization
+    h[np.diag_indices(n_rows)] += diag + self.L2
 
     return h
 
@@ -882,11 +1466,38 @@ class BeliefPropagation_Logistic:
     else:
       A_b = A[block][:, block]
 
-    E = np.linalg.eigh(A_b)[0]
+    E = np.linalg.eigh(dense(A_b))[0]
     L_block = np.max(E) + self.L2
     
     return L_block
 
+  def Lb_batch(self, x, A, b, blocks):
+    # Lb_func of every row of blocks
+    E = np.linalg.eigvalsh(block_submatrices(A, blocks))
+
+    return E[:, -1] + self.L2
+
   def Hb_func(self, x, A, b, block=None):
     # BeliefPropagation
-    return self.h_func(x, A, b, block)
\ No newline at end of file
+    return self.h_func(x, A, b, block)
+
+  def Hb_batch(self, x, A, b, blocks):
+    # Hb_func of every row of blocks, stacked
+    return np.array([self.h_func(x, A, b, block) for block in blocks])
+
+  def Hb_full_blocks(self, x, A, b, blocks):
+    # Blocks of Hb_func(block=None), the same as Hb_batch here
+    return self.Hb_batch(x, A, b, blocks)
+
+  def Hb_operator(self, x, A, b):
+    # Hb_func(block=None), whose edge terms are formed once
+    H = self.h_func(x, A, b)
+
+    return LinearOperator(H.shape, matvec=H.dot, rmatvec=H.dot, dtype=float)
+
+  def Hb_abs_rowsum(self, x, A, b):
+    # np.sum(np.abs(Hb_func(block=None)), 1) at the first x it is asked for
+    if self.Hb_rowsum is None:
+      self.Hb_rowsum = np.sum(np.abs(self.Hb_func(x, A, b)), 1)
+
+    return self.Hb_rowsum
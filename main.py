@@ -87,7 +87,9 @@ if __name__ == "__main__":
                                           L2=args.L2,
                                           root=ROOT,
                                           logs_path=logs_path,
-                                          datasets_path=datasets_path)
+                                          datasets_path=datasets_path,
+                                          checks={"monotone":args.assert_decrease,
+                                                  "gradient":args.test_grad})
 
                     avg_update_time = history["time"].values[-1]
                     legend = ut.legendFunc(p, s, u, args.p_rules, args.s_rules,
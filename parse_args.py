@@ -33,7 +33,7 @@ def parse():
     parser.add_argument('-l2','--L2', type=float, default=0)
     parser.add_argument('-t','--test_grad', type=int, default=0)
     parser.add_argument('-ti','--timeit', type=int, default=0)
-    parser.add_argument('-ad','--assert_decrease', type=int, default=1)
+    parser.add_argument('-ad','--assert_decrease', type=int, default=0)
     parser.add_argument('-d2o','--distance_to_optimal', type=int, default=0)
     parser.add_argument('-L_approx','--L_approx', type=int, default=0)
     parser.add_argument('-format','--format', default="pdf")
@@ -29,15 +29,13 @@ def get_partition(A, b, loss, block_size, p_rule):
 
   elif p_rule =="Hsort":
       # Group by lipschitz values
-      Hb = loss.Hb_func(None, A, b)
-      scores = np.sum(np.abs(Hb), 1)
+      scores = loss.Hb_abs_rowsum(None, A, b)
       block_indices = np.argsort(scores)
       n_blocks = int(n_params / block_size)
       fixed_blocks = get_fixed_blocks(block_indices, n_blocks, block_size)
 
   elif p_rule =="Havg":
-      Hb = loss.Hb_func(None, A, b)
-      scores = np.sum(np.abs(Hb), 1)
+      scores = loss.Hb_abs_rowsum(None, A, b)
       indices = np.argsort(scores)
       n_blocks = int(n_params / block_size)
       
@@ -1,11 +1,100 @@
 
+import os
+import hashlib
 import numpy as np
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+from . import priority_queues as pq
+from . import samplers
 from update_rules import update_rules as ur
 #from pulp import *
 import copy
 from scipy.sparse.linalg.eigen.arpack import eigsh as largest_eigsh
 
 
+def block_scores(rule, G, X, L):
+    """Greedy scores of the blocks whose gradients, coordinates and
+    lipschitz values are the rows of G, X and L"""
+    if L.ndim == 1:
+      # One lipschitz value per block
+      L = L[:, np.newaxis]
+
+    if rule == "GS":
+      return np.sum(np.abs(G), axis=1)
+
+    elif rule in ["GSL", "GSD"]:
+      return np.sum(np.abs(G) / np.sqrt(L), axis=1)
+
+    elif rule == "gsq-nn":
+      # Coordinates that would turn negative are moved to zero
+      d = -G / L
+      neg = (X + d) < 0
+      d[neg] = -X[neg]
+
+      return np.sum(np.abs(G * d + (L/2.) * d**2), axis=1)
+
+    raise ValueError("selection rule %s doesn't exist" % rule)
+
+
+def batched_lower_solve(C, G):
+    """Solves C[i] y[i] = G[i] for the stacked lower triangular C"""
+    Y = np.empty(G.shape)
+    for j in range(G.shape[1]):
+      Y[:, j] = ((G[:, j] - np.einsum('ik,ik->i', C[:, j, :j], Y[:, :j])) / 
+                 C[:, j, j])
+
+    return Y
+
+
+def problem_key(A, b, fixed_blocks):
+    """Digest of the contents of A, the shape of b and the partition"""
+    sha = hashlib.sha1()
+    if sparse.issparse(A):
+      A = A.tocsr()
+      A.sort_indices()
+      arrays = [A.data, A.indices, A.indptr]
+    else:
+      arrays = [np.asarray(A)]
+
+    sha.update(str((A.shape, np.shape(b))).encode())
+    for a in arrays + [fixed_blocks]:
+      sha.update(np.ascontiguousarray(a))
+
+    return sha.hexdigest()
+
+
+def get_Lb_list(x, A, b, loss, fixed_blocks, args):
+    """Lb of every block, computed in batches over args["Lb_threads"]
+    threads and cached in args["Lb_cache_dir"] when it is set. The cache
+    is keyed by the contents of A, so a regenerated dataset under the
+    same name gets new files."""
+    fname = None
+    if args.get("Lb_cache_dir"):
+      key = problem_key(A, b, fixed_blocks)
+      fname = os.path.join(args["Lb_cache_dir"], "%s_%s_%s_%s.npy" % 
+                           (args.get("dataset"), args["loss"], args["L2"], 
+                            key[:16]))
+
+      if os.path.exists(fname):
+        return np.load(fname)
+
+    n_threads = args.get("Lb_threads", 1)
+    if n_threads > 1:
+      chunks = [c for c in np.array_split(fixed_blocks, n_threads) if len(c)]
+      with ThreadPoolExecutor(n_threads) as pool:
+        Lb_list = list(pool.map(lambda c: loss.Lb_batch(x, A, b, c), chunks))
+      Lb_list = np.concatenate(Lb_list)
+    else:
+      Lb_list = loss.Lb_batch(x, A, b, fixed_blocks)
+
+    if fname is not None:
+      if not os.path.exists(args["Lb_cache_dir"]):
+        os.makedirs(args["Lb_cache_dir"])
+      np.save(fname, Lb_list)
+
+    return Lb_list
+
+
 def select(rule, x, A, b, loss, args,  partition, iteration):
     fixed_blocks = partition
     
@@ -33,202 +122,85 @@ def select(rule, x, A, b, loss, args,  partition, iteration):
 
     elif rule == "Lipschitz":
       """sample a random block proportional to L_b"""
-      Lb_func = loss.Lb_func
-
       if "Lb_list" not in args:
-        args["Lb_list"] = [] 
-        n_blocks = len(fixed_blocks)
+        args["Lb_list"] = get_Lb_list(x, A, b, loss, fixed_blocks, args)
 
-        # COMPUTE LB
-        for block in fixed_blocks:
-          Lb = Lb_func(x, A, b, block)
+      if "Lb_sampler" not in args:
+        args["Lb_sampler"] = samplers.AliasTable(args["Lb_list"])
 
-          #np.linalg.eig(A[:, features].T.dot(A[:, features]))[0]
-
-          args["Lb_list"] += [Lb]
-
-        args["Lb_list"] = np.array(args["Lb_list"])
-
-      block = fixed_blocks[np.random.choice(n_blocks, p=args["Lb_list"]/args["Lb_list"].sum())]
+      block = fixed_blocks[args["Lb_sampler"].sample()]
       return block, args
 
 
-    elif rule == "GS":
-      """ select a block based on the largest gradient sum"""
-      g_func = loss.g_func
-
-      best_block = -1
-      best_score = -1
-      
-      g = g_func(x, A, b, block=None)
-      
-      for i, block in enumerate(fixed_blocks):
-        g_block = g[block]
-        s = np.sum(np.abs(g_block))
-        #print "bs: %d, func: %.3f" % (len(block), s)
-        if s > best_score:
-          best_score = s
-          best_block = i
-          
-      
-      return fixed_blocks[best_block], args
-
-
-
-    elif rule == "GSL":
-      """ select a block based on the maximum eigen value"""
+    elif rule in ["GS", "GSL", "GSD", "gsq-nn",
+                  "GS-heap", "GSL-heap", "GSD-heap", "gsq-nn-heap"]:
+      """ select the block with the largest greedy score; the "-heap"
+          variants keep the block scores in a tournament tree and only
+          rescore the blocks coupled to the last block"""
       g_func = loss.g_func
-      Lb_func = loss.Lb_func
-      best_block = -1
-      best_score = -1
-
-
-      g = g_func(x, A, b, block=None)
-
-      if args["update_rule"] == "LA":
-
-          args["Lb_list"] = [] 
-          n_blocks = len(fixed_blocks)
+      base = rule.replace("-heap", "")
 
-          # COMPUTE LB
-          for block in fixed_blocks:
-            Lb = lipschitz[block]
-            #np.linalg.eig(A[:, features].T.dot(A[:, features]))[0]
-
-            args["Lb_list"] += [Lb]
-
-          args["Lb_list"] = np.array(args["Lb_list"])
-
-      else:
+      if base == "GSL" and args["update_rule"] != "LA":
         if "Lb_list" not in args:
-          args["Lb_list"] = [] 
-          n_blocks = len(fixed_blocks)
-
-          # COMPUTE LB
-          for block in fixed_blocks:
-            Lb = Lb_func(x, A, b, block)
+          args["Lb_list"] = get_Lb_list(x, A, b, loss, fixed_blocks, args)
 
-            #np.linalg.eig(A[:, features].T.dot(A[:, features]))[0]
+      def scores(rows):
+        if rows is None:
+          rows = np.arange(n_blocks)
+          g = g_func(x, A, b, block=None)[fixed_blocks]
+        else:
+          g = g_func(x, A, b, block=fixed_blocks[rows].ravel())
+          g = g.reshape(rows.size, -1)
 
-            args["Lb_list"] += [Lb]
+        if base == "GSL" and args["update_rule"] != "LA":
+          l = args["Lb_list"][rows]
+        else:
+          l = lipschitz[fixed_blocks[rows]]
 
-          args["Lb_list"] = np.array(args["Lb_list"])
+        return block_scores(base, g, x[fixed_blocks[rows]], l)
 
+      # The "-full" update rules change x outside the last block, which
+      # would leave stale scores in the tree
+      if rule == base or args["update_rule"].endswith("-full"):
+        best_block = np.argmax(scores(None))
 
-      for i, block in enumerate(fixed_blocks):
-        g_block = g[block]
-        L_block = args["Lb_list"][i]
+      else:
+        if "block_tree" not in args:
+          args["block_tree"] = pq.BlockScoreTree(scores(None))
+          args["block_owner"] = np.empty(x.size, int)
+          for i, block in enumerate(fixed_blocks):
+            args["block_owner"][block] = i
 
-        step_size = 1. / np.sqrt(L_block)
+        else:
+          last = fixed_blocks[args["block_tree_last"]]
+          rows = np.unique(args["block_owner"][loss.coupled(A, last)])
+          args["block_tree"].update(rows, scores(rows))
 
-        s = np.sum(np.abs(g_block) * step_size) 
+        best_block = args["block_tree"].best()
+        args["block_tree_last"] = best_block
 
-        if s > best_score:
-          best_score = s
-          best_block = i
-       
       return fixed_blocks[best_block], args
 
 
-    elif rule in ["GSD"]:
-      """ select a block based on the individual Lis"""
+    elif rule == "GSQ":
+      """ select a block based on the hessian"""
       g_func = loss.g_func
 
-      best_block = -1
-      best_score = -1
-      
       g = g_func(x, A, b, block=None)
-      l = lipschitz
 
-      for i, block in enumerate(fixed_blocks):
-        g_block = g[block]
-        l_block = l[block]
-        
-
-        s = np.sum(np.abs(g_block) / np.sqrt(l_block)) 
-
-        if s > best_score:
-          best_score = s
-          best_block = i
-       
-      return fixed_blocks[best_block], args
-
-    elif rule == "gsq-nn":
-      """ select coordinates based on largest individual lipschitz"""
-      g_func = loss.g_func
-
-      best_block = -1
-      best_score = -1
-      
-      g = g_func(x, A, b, block=None)
-      l = lipschitz
+      if "GSQ_Hb_chol" not in args:
+        # Cholesky factors of the (n_blocks x block_size x block_size) 
+        # diagonal blocks of Hb_func(block=None), formed from the columns
+        # of each block only
+        Hbb = loss.Hb_full_blocks(x, A, b, fixed_blocks)
+        I = np.eye(fixed_blocks.shape[1])
+        args["GSQ_Hb_chol"] = np.linalg.cholesky(Hbb + 1e-10*I)
 
-      for i, block in enumerate(fixed_blocks):
+      # g_b^T Hb^-1 g_b = |C^-1 g_b|^2 with Hb = C C^T
+      s = np.sqrt(np.sum(batched_lower_solve(args["GSQ_Hb_chol"], 
+                                             g[fixed_blocks])**2, axis=1))
 
-        Gb = g[block]
-        Lb = l[block]
-
-        xb = x[block]
-        d = -Gb / Lb
-
-        x_new = xb + d
-        neg = x_new < 0
-
-        pos = (1 - neg).astype(bool)
-
-        assert xb.size == (neg.sum() + pos.sum())
-
-        s = np.zeros(xb.size)
-        d = -Gb[pos] / Lb[pos]
-        s[pos] = np.abs(Gb[pos] * d + (Lb[pos]/2.) * d**2)
-
-        d = - xb[neg]
-        s[neg] = np.abs(Gb[neg] * d + (Lb[neg]/2.) * d**2)
-
-
-        s = np.sum(s) 
-        
-        if s > best_score:
-          best_score = s
-          best_block = i
-       
-      return fixed_blocks[best_block], args
-
-
-    elif rule == "GSQ":
-      """ select a block based on the hessian"""
-      g_func = loss.g_func
-      Hb_func = loss.Hb_func
-
-      best_block = -1
-      best_score = -1
-        
-      g = g_func(x, A, b, block=None)
-      if "GSQ_Hb" not in args:
-        args["GSQ_Hb"] = Hb_func(x, A, b, block=None)
-
-      Hb = args["GSQ_Hb"]
-
-      #H = h_func(x, A, b, args, None)
-      if "GSQ_Hb_inv" not in args:
-       args["GSQ_Hb_inv"] = [0]*len(fixed_blocks)
-
-      for i, block in enumerate(fixed_blocks):
-        g_block = g[block]
-        
-        if isinstance(args["GSQ_Hb_inv"][i], (int,float)):
-          hb =  Hb[block][:,block]
-          args["GSQ_Hb_inv"][i] = np.linalg.inv(hb + 1e-10*np.eye(len(hb)))
-
-        s = np.dot(args["GSQ_Hb_inv"][i], g_block)
-        s = np.dot(g_block.T, s)
-        s = np.sqrt(s)
-
-        if s > best_score:
-          best_score = s
-          best_block = i
-       
-      return fixed_blocks[best_block], args
+      return fixed_blocks[np.argmax(s)], args
       
     else:
       raise ValueError("selection rule %s doesn't exist" % rule)
\ No newline at end of file
@@ -1,11 +1,70 @@
 from . import tree_algorithms as ta
+from . import priority_queues as pq
+from . import samplers
 
 import numpy as np
-from update_rules import update_rules as ur
+from checks import CheckedMode
 #from pulp import *
-import copy
 from scipy.sparse.linalg.eigen.arpack import eigsh as largest_eigsh
 from itertools import cycle
+
+
+def top_k(s, k, smallest=False):
+    """Same as np.argsort(s, axis=None)[-k:], or [:k] if smallest, but
+    in O(n) through argpartition.
+
+    Which of several entries tied with the k-th value are taken depends
+    on argsort's tie order, so s with such ties goes through argsort."""
+    s = np.ravel(s)
+    if k >= s.size:
+      return np.argsort(s)
+
+    if smallest:
+      part = np.argpartition(s, k - 1)
+      top, rest, kth = part[:k], part[k:], s[part[k - 1]]
+    else:
+      part = np.argpartition(s, -k)
+      top, rest, kth = part[-k:], part[:-k], s[part[-k]]
+
+    if np.any(s[rest] == kth):
+      order = np.argsort(s)
+      return order[:k] if smallest else order[-k:]
+
+    return top[np.argsort(s[top])]
+
+
+def heap_top_k(scores, x, A, b, loss, args, k):
+    """Like top_k, but keeps the scores in a heap across iterations.
+
+    Only the coordinates coupled to the previously selected block are
+    rescored, which assumes x changed in that block alone. The "-full"
+    update rules change x everywhere, so they get a plain top_k."""
+    if args.get("update_rule", "").endswith("-full"):
+      return top_k(scores(None), k)
+
+    if "score_heap" not in args:
+      args["score_heap"] = pq.ScoreHeap(scores(None))
+    else:
+      ind = loss.coupled(A, args["score_heap_block"])
+      args["score_heap"].update(ind, scores(ind))
+
+    block = args["score_heap"].top(k)
+    args["score_heap_block"] = block
+
+    return block
+
+
+def get_checks(args):
+    # The run's CheckedMode, or the default checks outside train()
+    if "checks" not in args:
+      args["checks"] = CheckedMode()
+
+    return args["checks"]
+
+
+def _at(v, ind):
+    return v if ind is None else v[ind]
+
 ########### ------------------------------ ADAPTIVE RULES
 def select(rule, x, A, b, loss, args, iteration):
     if rule is None:
@@ -31,8 +90,11 @@ def select(rule, x, A, b, loss, args, iteration):
 
     elif rule == "Random":
        """ randomly select a coordinate"""
-       all_block = np.random.permutation(n_params)
-       block = all_block[:block_size]
+       if "random_stream" not in args:
+         args["random_stream"] = samplers.RandomBlockStream(n_params, 
+                                                            block_size)
+
+       block = args["random_stream"].next().copy()
 
        #block = np.unravel_index(block,  (n_features, n_classes))
 
@@ -50,17 +112,35 @@ def select(rule, x, A, b, loss, args, iteration):
 
     elif rule == "Lipschitz":
       """non-uniform sample based on lipschitz values"""
-      L = lipschitz
+      if "lipschitz_sampler" not in args:
+        args["lipschitz_sampler"] = samplers.FenwickSampler(lipschitz)
 
-      block = np.random.choice(x.size, block_size, replace=False,
-                               p=L/L.sum())
+      block = args["lipschitz_sampler"].sample(block_size, replace=False)
     
+    elif rule in ["GS-heap", "GSD-heap", "GSDLi-heap", "GSDHb-heap"]:
+      """ same as the rules without the suffix, with the scores kept
+          in a heap and updated around the last block"""
+      if rule == "GSDHb-heap" and "GSD_L" not in args:
+        args["GSD_L"] = loss.Hb_abs_rowsum(x, A, b)
+
+      if rule == "GS-heap":
+        L = np.ones(x.size)
+      elif rule == "GSDHb-heap":
+        L = args["GSD_L"]
+      else:
+        L = lipschitz
+
+      scores = lambda ind: (np.abs(g_func(x, A, b, block=ind)) / 
+                            np.sqrt(_at(L, ind)))
+
+      block = heap_top_k(scores, x, A, b, loss, args, block_size)
+
     elif rule in ["GS"]:
       """ select coordinates based on largest gradients"""
       g = g_func(x, A, b, block=None)
       s = np.abs(g)
 
-      block = np.argsort(s, axis=None)[-block_size:]
+      block = top_k(s, block_size)
 
     elif rule in ["GSDLi", "GSD"]:
       """ select coordinates based on largest individual lipschitz"""
@@ -69,26 +149,26 @@ def select(rule, x, A, b, loss, args, iteration):
 
       s = np.abs(g) / np.sqrt(L)
                                      
-      block = np.argsort(s, axis=None)[-block_size:]
+      block = top_k(s, block_size)
 
     elif rule in ["GSDHb"]:
       """ select coordinates based on the uper bound of the hessian"""
       g = g_func(x, A, b, block=None)
 
       if "GSD_L" not in args:
-        Hb = loss.Hb_func(x, A, b, block=None)
-        
-        args["GSD_L"] = np.sum(np.abs(Hb), 1)
+        args["GSD_L"] = loss.Hb_abs_rowsum(x, A, b)
 
       s = np.abs(g) / np.sqrt(args["GSD_L"])
                                      
-      block = np.argsort(s, axis=None)[-block_size:]
+      block = top_k(s, block_size)
 
     elif rule in ["GSQ-IHT", "IHT"]:
       """ select coordinates based on largest individual lipschitz"""
       L = lipschitz
       if "Hb_IHT" not in args:
-        args["Hb_IHT"] = loss.Hb_func(x, A, b, block=None)
+        # Matrix-free Hb, so that neither the eigenvalue estimate nor
+        # the iterations below need the d x d matrix
+        args["Hb_IHT"] = loss.Hb_operator(x, A, b)
 
         #args["mu_IHT"] = 1. / np.max(np.linalg.eigh(args["Hb_IHT"])[0])
         args["mu_IHT"] = 1. / largest_eigsh(args["Hb_IHT"], 1, which='LM')[0]
@@ -103,41 +183,52 @@ def select(rule, x, A, b, loss, args, iteration):
       for i in range(10):
 
         d = d - mu*(G + Hb.dot(d))
-        ind = np.argsort(np.abs(d))
-        d[ind[:-block_size]]= 0
+        top = top_k(np.abs(d), block_size)
+        keep = np.zeros(d.size, bool)
+        keep[top] = True
+        d[~keep] = 0
 
         if np.linalg.norm(d_old - d) < 1e-10:
 
-          block = ind[-block_size:]
+          block = top
           break
         #print "norm diff: %.3f" % np.linalg.norm(d_old - d)
         d_old = d.copy()
-        block = ind[-block_size:]
+        block = top
       #block = np.where(d != 0)
       return np.array(block), args
 
-    elif rule == "gsq-nn":
+    elif rule in ["gsq-nn", "gsq-nn-heap"]:
       """ select coordinates based on largest individual lipschitz"""
-      g = g_func(x, A, b, block=None)
-      L = lipschitz
-      d = -g / L
+      def scores(ind):
+        g = g_func(x, A, b, block=ind)
+        L = _at(lipschitz, ind)
+        x_ind = _at(x, ind)
+        d = -g / L
 
-      x_new = x + d
-      neg = x_new < 0
+        x_new = x_ind + d
+        neg = x_new < 0
 
-      pos = (1 - neg).astype(bool)
-      
-      # SANITY CHECK
-      assert x.size == (neg.sum() + pos.sum())
+        pos = (1 - neg).astype(bool)
+        
+        # SANITY CHECK
+        assert x_ind.size == (neg.sum() + pos.sum())
+
+        s = np.zeros(x_ind.size)
+        d = -g[pos] / L[pos]
+        s[pos] = g[pos] * d + (L[pos]/2.) * d**2
+
+        d = - x_ind[neg]
+        s[neg] = g[neg] * d + (L[neg]/2.) * d**2
 
-      s = np.zeros(x.size)
-      d = -g[pos] / L[pos]
-      s[pos] = g[pos] * d + (L[pos]/2.) * d**2
+        return s
 
-      d = - x[neg]
-      s[neg] = g[neg] * d + (L[neg]/2.) * d**2
-                        
-      block = np.argsort(s, axis=None)[:block_size]
+      # The best coordinates have the most negative progress bound
+      if rule == "gsq-nn-heap":
+        block = heap_top_k(lambda ind: -scores(ind), x, A, b, loss, args,
+                           block_size)
+      else:
+        block = top_k(scores(None), block_size, smallest=True)
     
     elif rule in ["GSDTree", "GSTree","RTree", "GSLTree"]:
 
@@ -146,7 +237,7 @@ def select(rule, x, A, b, loss, args, iteration):
 
       
       if "GSDTree" == rule:
-        lipschitz = np.sum(np.abs(A), 1)
+        lipschitz = np.asarray(abs(A).sum(axis=1)).ravel()
         score_list = np.abs(g_func(x, A, b, None)) / np.sqrt(lipschitz)
         sorted_indices = np.argsort(score_list)[::-1] 
 
@@ -162,18 +253,9 @@ def select(rule, x, A, b, loss, args, iteration):
       elif "RTree" == rule:
         sorted_indices = np.random.permutation(np.arange(A.shape[0]))
 
-      block = ta.get_tree_slow(sorted_indices, adj=A)
+      block = ta.get_tree(sorted_indices, adj=A)
       
-      if iteration == 0:
-        xr =  np.random.randn(*x.shape)
-        xE, _ = ur.update("bpExact", xr.copy(), 
-                                 A, b, loss, copy.deepcopy(args), block, iteration=iteration)
-        xG, _ = ur.update("bpGabp", xr.copy(), 
-                                A, b, loss, copy.deepcopy(args) , block, iteration=iteration)
-
-        np.testing.assert_array_almost_equal(xE, xG, 3)
-
-        print("Exact vs GaBP Test passed...")
+      get_checks(args).exact_gabp(iteration, A, b, loss, args, block)
 
 
     elif rule == "GSExactTree":
@@ -184,7 +266,7 @@ def select(rule, x, A, b, loss, args, iteration):
       s = np.abs(g)
       
       block_size = int(loss.n_params**(1./3))
-      block = np.argsort(s, axis=None)[-block_size:]
+      block = top_k(s, block_size)
 
     elif rule == "GSLExactTree":
       """ select coordinates based on largest individual lipschitz"""
@@ -195,12 +277,13 @@ def select(rule, x, A, b, loss, args, iteration):
       s = np.abs(g) / np.sqrt(l)
       
       block_size = int(loss.n_params**(1./3))
-      block = np.argsort(s, axis=None)[-block_size:]
+      block = top_k(s, block_size)
 
 
     elif rule in ["TreePartitions", "RedBlackTree", 
                   "TreePartitionsRandom", 
-                  "RedBlackTreeRandom"]:
+                  "RedBlackTreeRandom", "RedBlackTreeLargestFirst",
+                  "RedBlackTreeDSATUR"]:
       """ select coordinates that form a forest based on BGS or BGSC """
            
       g_func = loss.g_func 
@@ -221,6 +304,12 @@ def select(rule, x, A, b, loss, args, iteration):
           elif rule == "RedBlackTreeRandom":
             graph_blocks = ta.get_rb_general_graph(Wb, L=np.ones(lipschitz.size))
 
+          elif rule == "RedBlackTreeLargestFirst":
+            graph_blocks = ta.get_rb_general_graph(Wb, ordering="largest_first")
+
+          elif rule == "RedBlackTreeDSATUR":
+            graph_blocks = ta.get_rb_general_graph(Wb, ordering="dsatur")
+
           elif rule == "TreePartitionsRandom":     
             graph_blocks = ta.get_tp_general_graph(Wb, L=np.ones(lipschitz.size))
 
@@ -245,19 +334,13 @@ def select(rule, x, A, b, loss, args, iteration):
 
         
         #################### SANITY CHECK
-        if rule in ["RedBlackTree", "RedBlackTreeRandom"]:
+        if "RedBlackTree" in rule:
           # Assert all blocks have diagonal dependencies
-          for tmp_block in graph_blocks:
-            tmp = A[tmp_block][:, tmp_block]
-            assert np.all(tmp == np.diag(np.diag(tmp)))
+          get_checks(args).partition("RedBlack", graph_blocks, A)
 
-        elif rule in ["TreePartitions","TreePartitionsRandom"]:
-          # Assert all blocks are forests/acyclic
-          for tmp_block in graph_blocks:
-            W_tmp = (Wb[tmp_block][:, tmp_block] != 0).astype(int)
-            assert ta.isForest(W_tmp) 
         else:
-          raise ValueError("%s - No" % rule)
+          # Assert all blocks are forests/acyclic
+          get_checks(args).partition("Tree", graph_blocks, Wb)
 
         args["graph_blocks"] = cycle(graph_blocks)
        
@@ -270,16 +353,7 @@ def select(rule, x, A, b, loss, args, iteration):
       # tmp = A[block][:, block]
       # assert np.all(tmp == np.diag(np.diag(tmp)))  
 
-      if iteration == 0:
-        x = np.random.randn(A.shape[1])
-        xr =  np.random.randn(*x.shape)
-        xE, _ = ur.update("bpExact", xr.copy(), 
-                                 A, b, loss, copy.deepcopy(args), block, iteration)
-        xG, _ = ur.update("bpGabp", xr.copy(), 
-                                A, b, loss, copy.deepcopy(args) , block, iteration)
-
-        np.testing.assert_array_almost_equal(xE, xG, 3)
-        print("Exact vs GaBP Test passed...")
+      get_checks(args).exact_gabp(iteration, A, b, loss, args, block)
 
     else:
       raise ValueError("selection rule %s doesn't exist" % rule)
@@ -0,0 +1,149 @@
+import numpy as np
+from numba import jit
+
+
+###########################
+# Indexed max-heap over coordinate scores
+###########################
+class ScoreHeap:
+    """Max-heap over the scores of d coordinates.
+
+    The score of any coordinate can be changed in O(log d), so after a
+    block update only the coordinates whose gradient changed need to be
+    rescored before the k best coordinates are read in O(k log d).
+    """
+    def __init__(self, scores):
+        self.key = np.array(scores, dtype=float)
+        self.heap = np.argsort(-self.key)
+        self.pos = np.empty(self.key.size, dtype=np.int64)
+        self.pos[self.heap] = np.arange(self.key.size)
+
+    def update(self, indices, scores):
+        _heap_update(self.heap, self.pos, self.key,
+                     np.asarray(indices, dtype=np.int64),
+                     np.asarray(scores, dtype=float))
+
+    def top(self, k):
+        """Returns the k coordinates with the largest scores."""
+        return _heap_top(self.heap, self.pos, self.key, k)
+
+
+@jit(nopython=True)
+def _sift_up(heap, pos, key, i):
+    while i > 0:
+        parent = (i - 1) // 2
+        if key[heap[parent]] >= key[heap[i]]:
+            break
+
+        heap[parent], heap[i] = heap[i], heap[parent]
+        pos[heap[parent]] = parent
+        pos[heap[i]] = i
+        i = parent
+
+
+@jit(nopython=True)
+def _sift_down(heap, pos, key, i, size):
+    while True:
+        best = i
+        left = 2 * i + 1
+        right = left + 1
+        if left < size and key[heap[left]] > key[heap[best]]:
+            best = left
+        if right < size and key[heap[right]] > key[heap[best]]:
+            best = right
+        if best == i:
+            break
+
+        heap[best], heap[i] = heap[i], heap[best]
+        pos[heap[best]] = best
+        pos[heap[i]] = i
+        i = best
+
+
+@jit(nopython=True)
+def _heap_update(heap, pos, key, indices, scores):
+    for m in range(indices.size):
+        j = indices[m]
+        key[j] = scores[m]
+        _sift_up(heap, pos, key, pos[j])
+        _sift_down(heap, pos, key, pos[j], heap.size)
+
+
+@jit(nopython=True)
+def _heap_top(heap, pos, key, k):
+    # Pop the k largest entries and push them back
+    size = heap.size
+    top = np.empty(k, dtype=np.int64)
+    for m in range(k):
+        top[m] = heap[0]
+
+        size -= 1
+        heap[0], heap[size] = heap[size], heap[0]
+        pos[heap[0]] = 0
+        pos[heap[size]] = size
+        _sift_down(heap, pos, key, 0, size)
+
+    for m in range(k):
+        size += 1
+        _sift_up(heap, pos, key, size - 1)
+
+    return top
+
+
+###########################
+# Tournament tree over block scores
+###########################
+class BlockScoreTree:
+    """Tournament tree over the scores of n blocks.
+
+    Every internal node holds the winner of its two children, so the
+    best block is read at the root and changing the score of a block
+    replays the O(log n) matches on its path to the root.
+    """
+    def __init__(self, scores):
+        n = len(scores)
+        self.size = 1
+        while self.size < n:
+            self.size *= 2
+
+        self.key = np.full(self.size, -np.inf)
+        self.key[:n] = scores
+        self.winner = np.zeros(2 * self.size, dtype=np.int64)
+        self.winner[self.size:] = np.arange(self.size)
+        _tree_build(self.winner, self.key, self.size)
+
+    def update(self, indices, scores):
+        _tree_update(self.winner, self.key, self.size,
+                     np.asarray(indices, dtype=np.int64),
+                     np.asarray(scores, dtype=float))
+
+    def best(self):
+        """Returns the block with the largest score."""
+        return self.winner[1]
+
+
+@jit(nopython=True)
+def _tree_match(winner, key, node):
+    left = winner[2 * node]
+    right = winner[2 * node + 1]
+    # Ties go to the lower block index, like a scan with ">"
+    if key[right] > key[left]:
+        winner[node] = right
+    else:
+        winner[node] = left
+
+
+@jit(nopython=True)
+def _tree_build(winner, key, size):
+    for node in range(size - 1, 0, -1):
+        _tree_match(winner, key, node)
+
+
+@jit(nopython=True)
+def _tree_update(winner, key, size, indices, scores):
+    for m in range(indices.size):
+        key[indices[m]] = scores[m]
+        node = (indices[m] + size) // 2
+        while node > 0:
+            _tree_match(winner, key, node)
+            node //= 2
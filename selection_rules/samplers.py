@@ -0,0 +1,203 @@
+import numpy as np
+from numba import jit
+
+
+###########################
+# Walker alias table
+###########################
+class AliasTable:
+    """Samples indices with probability proportional to fixed weights.
+
+    The table is built once in O(n); every draw then costs O(1): pick a
+    bucket uniformly, and keep it or take its alias by a biased coin.
+    """
+    def __init__(self, weights):
+        w = np.asarray(weights, dtype=float)
+        self.n = w.size
+        self.prob, self.alias = _alias_build(w * self.n / w.sum())
+
+    def sample(self, size=None):
+        """Draws size indices with replacement (one if size is None)."""
+        i = np.random.randint(self.n, size=size)
+        u = np.random.random(size=size)
+
+        return np.where(u < self.prob[i], i, self.alias[i])
+
+
+@jit(nopython=True)
+def _alias_build(p):
+    n = p.size
+    prob = np.ones(n)
+    alias = np.arange(n)
+
+    small = np.empty(n, dtype=np.int64)
+    large = np.empty(n, dtype=np.int64)
+    n_small = 0
+    n_large = 0
+    for i in range(n):
+        if p[i] < 1.:
+            small[n_small] = i
+            n_small += 1
+        else:
+            large[n_large] = i
+            n_large += 1
+
+    # Fill every small bucket with the excess of a large one
+    while n_small > 0 and n_large > 0:
+        n_small -= 1
+        s = small[n_small]
+        l = large[n_large - 1]
+
+        prob[s] = p[s]
+        alias[s] = l
+        p[l] -= 1. - p[s]
+
+        if p[l] < 1.:
+            n_large -= 1
+            small[n_small] = l
+            n_small += 1
+
+    return prob, alias
+
+
+###########################
+# Fenwick tree over weights
+###########################
+class FenwickSampler:
+    """Samples indices with probability proportional to fixed weights,
+    with or without replacement.
+
+    Every draw costs O(log n). Without replacement, drawn indices are
+    removed from the tree in O(log n) and put back after the block, so
+    a block of k indices costs O(k log n) instead of the O(n) of
+    np.random.choice. Use AliasTable for draws with replacement.
+    """
+    def __init__(self, weights):
+        self.weights = np.array(weights, dtype=float)
+        self.tree = _fenwick_build(self.weights)
+
+    def sample(self, size=1, replace=True):
+        """Draws size indices, with or without replacement."""
+        u = np.random.random(size)
+
+        return _fenwick_sample(self.tree, self.weights, u, replace)
+
+
+@jit(nopython=True)
+def _fenwick_build(weights):
+    n = weights.size
+    tree = np.zeros(n + 1)
+    for i in range(n):
+        j = i + 1
+        tree[j] += weights[i]
+        parent = j + (j & -j)
+        if parent <= n:
+            tree[parent] += tree[j]
+
+    return tree
+
+
+@jit(nopython=True)
+def _fenwick_add(tree, i, delta):
+    j = i + 1
+    while j < tree.size:
+        tree[j] += delta
+        j += j & -j
+
+
+@jit(nopython=True)
+def _fenwick_find(tree, target):
+    # Smallest i whose prefix sum of weights exceeds target
+    n = tree.size - 1
+    step = 1
+    while 2 * step <= n:
+        step *= 2
+
+    j = 0
+    while step > 0:
+        if j + step <= n and tree[j + step] <= target:
+            j += step
+            target -= tree[j]
+        step //= 2
+
+    return min(j, n - 1)
+
+
+@jit(nopython=True)
+def _fenwick_sample(tree, weights, u, replace):
+    n = tree.size - 1
+    total = 0.
+    j = n
+    while j > 0:
+        total += tree[j]
+        j -= j & -j
+
+    k = u.size
+    out = np.empty(k, dtype=np.int64)
+    removed = np.empty(k)
+    for m in range(k):
+        i = _fenwick_find(tree, u[m] * total)
+        # Rounding can land on a zero weight at the end of the range
+        while weights[i] == 0. and i > 0:
+            i -= 1
+
+        out[m] = i
+        if not replace:
+            removed[m] = weights[i]
+            total -= weights[i]
+            _fenwick_add(tree, i, -weights[i])
+            weights[i] = 0.
+
+    if not replace:
+        # Put the drawn weights back
+        for m in range(k):
+            weights[out[m]] = removed[m]
+            _fenwick_add(tree, out[m], removed[m])
+
+    return out
+
+
+###########################
+# Stream of uniform random blocks
+###########################
+class RandomBlockStream:
+    """Uniformly random blocks of k distinct indices out of n.
+
+    Blocks are drawn chunk_size at a time with Floyd's algorithm,
+    vectorized over the chunk, so every block costs O(k^2) work
+    instead of a permutation of all n indices. The stream has its own
+    generator, seeded from numpy's global RNG unless a seed is given,
+    so runs seeded alike produce the same blocks in any process.
+    """
+    def __init__(self, n, k, chunk_size=1024, seed=None):
+        assert 0 < k <= n
+        if seed is None:
+            seed = np.random.randint(2**31 - 1)
+
+        self.n = n
+        self.k = k
+        self.chunk_size = chunk_size
+        self.rng = np.random.default_rng(seed)
+        self.chunk = None
+        self.next_row = chunk_size
+
+    def next(self):
+        if self.next_row == self.chunk_size:
+            self.chunk = self.draw_chunk()
+            self.next_row = 0
+
+        block = self.chunk[self.next_row]
+        self.next_row += 1
+
+        return block
+
+    def draw_chunk(self):
+        # Floyd: for j = n-k, ..., n-1 add a uniform t in [0, j],
+        # or j itself if t was already chosen
+        blocks = np.empty((self.chunk_size, self.k), dtype=np.int64)
+        for m, j in enumerate(range(self.n - self.k, self.n)):
+            t = self.rng.integers(0, j + 1, size=self.chunk_size)
+            taken = np.any(blocks[:, :m] == t[:, np.newaxis], axis=1)
+            blocks[:, m] = np.where(taken, j, t)
+
+        return blocks
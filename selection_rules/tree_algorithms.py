@@ -1,11 +1,86 @@
+import heapq
 import numpy as np
+from scipy import sparse
+from numba import jit
+
+def get_neighbors(adj, i):
+    # Column indices of the non-zeros in row i of a dense or sparse adj
+    if sparse.issparse(adj):
+      return adj[i].nonzero()[1]
+
+    return np.nonzero(adj[i])[0]
+
+def to_csr(adj):
+    # CSR adjacency of a dense or sparse adj; explicit zeros are kept
+    # in the structure, so the builders below skip zero entries
+    if sparse.isspmatrix_csr(adj):
+      return adj
+
+    return sparse.csr_matrix(adj)
+
+@jit(nopython=True)
+def find(parent, i):
+    # Root of i, halving the path on the way up
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+
+    return i
+
+@jit(nopython=True)
+def grow_forest(order, indptr, indices, data, parent, stamp, in_block):
+    # Adds the nodes of order, in turn, to the forest encoded by parent
+    # (-1 outside the forest) unless two of their neighbours in the
+    # forest already share a tree, which would close a cycle
+    for c in order:
+      if parent[c] != -1:
+        continue
+
+      acyclic = True
+      for m in range(indptr[c], indptr[c + 1]):
+        j = indices[m]
+        if j == c or data[m] == 0 or parent[j] == -1:
+          continue
+
+        root = find(parent, j)
+        if stamp[root] == c:
+          acyclic = False
+          break
+        stamp[root] = c
+
+      if not acyclic:
+        continue
+
+      parent[c] = c
+      for m in range(indptr[c], indptr[c + 1]):
+        j = indices[m]
+        if j == c or data[m] == 0 or parent[j] == -1:
+          continue
+
+        parent[find(parent, j)] = c
+
+      in_block[c] = True
+
+def get_tree(sorted_indices, adj):
+    """Greedy forest over the nodes of sorted_indices, taken in order;
+    same block as get_tree_slow in near-linear time."""
+    adj = to_csr(adj)
+    n = adj.shape[0]
+
+    parent = -np.ones(n, dtype=np.int64)
+    stamp = -np.ones(n, dtype=np.int64)
+    in_block = np.zeros(n, dtype=np.bool_)
+    grow_forest(np.asarray(sorted_indices, dtype=np.int64), adj.indptr, 
+                adj.indices, adj.data, parent, stamp, in_block)
+
+    return np.flatnonzero(in_block)
 
 def get_tree_slow(sorted_indices, adj):
     block = []       
     treeNumber = {}
     nTrees = 0
     for coordinate in sorted_indices:
-      neighbors = np.nonzero(adj[coordinate])[0]
+      neighbors = get_neighbors(adj, coordinate)
       nn = np.intersect1d(neighbors, block)
       neighTrees = set()
 
@@ -106,7 +181,72 @@ class ForestBuilder:
     return True
 
 #### GENERAL GRAPH
+@jit(nopython=True)
+def color_forests(order, indptr, indices, data):
+  # Puts every node of order, in turn, in the first forest where it
+  # closes no cycle. Forests are disjoint, so one union-find (parent)
+  # holds all of them; bad[f] == c marks forest f as closed to node c
+  n = indptr.size - 1
+  parent = -np.ones(n, dtype=np.int64)
+  forest = -np.ones(n, dtype=np.int64)
+  stamp = -np.ones(n, dtype=np.int64)
+  bad = -np.ones(n, dtype=np.int64)
+  n_forests = 0
+
+  for c in order:
+    for m in range(indptr[c], indptr[c + 1]):
+      j = indices[m]
+      if j == c or data[m] == 0 or parent[j] == -1:
+        continue
+
+      root = find(parent, j)
+      if stamp[root] == c:
+        bad[forest[j]] = c
+      stamp[root] = c
+
+    f = 0
+    while f < n_forests and bad[f] == c:
+      f += 1
+    if f == n_forests:
+      n_forests += 1
+
+    parent[c] = c
+    forest[c] = f
+    for m in range(indptr[c], indptr[c + 1]):
+      j = indices[m]
+      if j == c or data[m] == 0 or parent[j] == -1 or forest[j] != f:
+        continue
+
+      parent[find(parent, j)] = c
+
+  return forest
+
 def get_tp_general_graph(W, L=None):
+  W = to_csr(W)
+
+  n_nodes = W.shape[0]
+  nodeIndices = np.arange(n_nodes)
+  if L is not None:
+    nodeIndices = np.argsort(L)[::-1]
+
+  forest = color_forests(nodeIndices.astype(np.int64), W.indptr, W.indices, 
+                         W.data)
+
+  # Blocks list their nodes in the order they were added
+  nodes = nodeIndices[np.argsort(forest[nodeIndices], kind="stable")]
+  sizes = np.bincount(forest)
+  blocks = np.split(nodes, np.cumsum(sizes)[:-1])
+
+  # SANITY CHECK
+  alls = np.hstack(blocks)
+
+  assert np.unique(alls).size == alls.size
+  assert alls.size == n_nodes
+  #
+  return tuple(blocks)
+
+
+def get_tp_general_graph_slow(W, L=None):
   forestDict = {}
 
   n_nodes = W.shape[0]
@@ -148,18 +288,193 @@ def get_tp_general_graph(W, L=None):
   return tuple([np.array(b) for b in blocks])
 
 
-def isForest(Wb):
-  n = Wb.shape[0]
+def induced_pattern(adj, block=None):
+  # Symmetric CSR non-zero pattern of adj, restricted to block
+  adj = to_csr(adj)
+  if block is not None:
+    adj = adj[block][:, block]
+
+  P = adj != 0
+
+  return (P + P.T).tocsr()
+
+@jit(nopython=True)
+def scan_edges(indptr, indices):
+  # Off-diagonal edges and self-loops of a symmetric pattern, and
+  # whether the off-diagonal edges are acyclic (union-find)
+  n = indptr.size - 1
+  parent = np.arange(n)
+  n_edges = 0
+  n_loops = 0
+  acyclic = True
+
+  for i in range(n):
+    for m in range(indptr[i], indptr[i + 1]):
+      j = indices[m]
+      if j == i:
+        n_loops += 1
+        continue
+      if j < i:
+        continue
+
+      n_edges += 1
+      ri = find(parent, i)
+      rj = find(parent, j)
+      if ri == rj:
+        acyclic = False
+      else:
+        parent[ri] = rj
+
+  return n_edges, n_loops, acyclic
+
+def isForest(Wb, block=None):
+  # Whether the graph of Wb (restricted to block) has no cycles; a
+  # self-loop counts as a cycle
+  P = induced_pattern(Wb, block)
+  n_edges, n_loops, acyclic = scan_edges(P.indptr, P.indices)
+
+  return acyclic and n_loops == 0
+
+def isIndependentSet(adj, block):
+  # Whether adj has no off-diagonal entries between nodes of block
+  P = induced_pattern(adj, block)
+  n_edges, n_loops, acyclic = scan_edges(P.indptr, P.indices)
+
+  return n_edges == 0
+
+@jit(nopython=True)
+def pick_color(c, indptr, indices, data, color, counts, n_colors, balanced):
+  # Color for node c among those unused by its neighbours: the least
+  # used one if balanced, the smallest one otherwise; n_colors if none
+  used = np.zeros(n_colors + 1, dtype=np.bool_)
+  for m in range(indptr[c], indptr[c + 1]):
+    j = indices[m]
+    if j != c and data[m] != 0 and color[j] != -1:
+      used[color[j]] = True
+
+  best = n_colors
+  for k in range(n_colors):
+    if used[k]:
+      continue
+    if not balanced:
+      return k
+    if best == n_colors or counts[k] < counts[best]:
+      best = k
+
+  return best
+
+@jit(nopython=True)
+def color_in_order(order, indptr, indices, data, balanced):
+  # Greedy coloring of the nodes in a fixed order
+  n = indptr.size - 1
+  color = -np.ones(n, dtype=np.int64)
+  counts = np.zeros(n + 1, dtype=np.int64)
+  n_colors = 0
+
+  for c in order:
+    k = pick_color(c, indptr, indices, data, color, counts, n_colors, 
+                   balanced)
+    if k == n_colors:
+      n_colors += 1
+    color[c] = k
+    counts[k] += 1
+
+  return color
+
+@jit(nopython=True)
+def color_dsatur(indptr, indices, data):
+  # DSATUR: color next the node with the most distinct neighbour colors,
+  # breaking ties by degree; returns the colors and the order used
+  n = indptr.size - 1
+  color = -np.ones(n, dtype=np.int64)
+  counts = np.zeros(n + 1, dtype=np.int64)
+  saturation = np.zeros(n, dtype=np.int64)
+  degree = np.diff(indptr).astype(np.int64)
+  order = np.empty(n, dtype=np.int64)
+  n_colors = 0
+
+  # Max-heap with lazy deletion of outdated entries
+  heap = [(0, 0, 0)]
+  heapq.heappop(heap)
+  for i in range(n):
+    heapq.heappush(heap, (0, -degree[i], i))
+
+  for step in range(n):
+    while True:
+      sat, _, c = heapq.heappop(heap)
+      if color[c] == -1 and -sat == saturation[c]:
+        break
 
-  Laplacian = Wb.copy()
-  Laplacian[np.diag_indices(n)] = Wb.sum(1)
-  
-  LHS = 0.5*np.trace(Laplacian)
-  RHS = np.linalg.matrix_rank(Laplacian)
+    k = pick_color(c, indptr, indices, data, color, counts, n_colors, False)
+    if k == n_colors:
+      n_colors += 1
+    color[c] = k
+    counts[k] += 1
+    order[step] = c
+
+    for m in range(indptr[c], indptr[c + 1]):
+      j = indices[m]
+      if j == c or data[m] == 0 or color[j] != -1:
+        continue
+
+      # Is k new among the colors around j?
+      new = True
+      for q in range(indptr[j], indptr[j + 1]):
+        l = indices[q]
+        if l != c and data[q] != 0 and color[l] == k:
+          new = False
+          break
+
+      if new:
+        saturation[j] += 1
+        heapq.heappush(heap, (-saturation[j], -degree[j], np.int64(j)))
+
+  return color, order
+
+def get_rb_general_graph(W, L=None, ordering="lipschitz"):
+  """Color classes of a greedy coloring of W, each an independent set.
+
+  ordering is "lipschitz" (nodes by decreasing L, each taking the least
+  used admissible color), "largest_first" (nodes by decreasing degree)
+  or "dsatur"; the last two take the smallest admissible color."""
+  W = to_csr(W)
+  n_nodes = W.shape[0]
+
+  if ordering == "dsatur":
+    color, nodeIndices = color_dsatur(W.indptr, W.indices, W.data)
+
+  else:
+    if ordering == "lipschitz":
+      nodeIndices = np.arange(n_nodes)
+      if L is not None:
+        nodeIndices = np.argsort(L)[::-1]
+
+    elif ordering == "largest_first":
+      degree = np.diff((W != 0).tocsr().indptr)
+      nodeIndices = np.argsort(-degree, kind="stable")
+
+    else:
+      raise ValueError("ordering %s doesn't exist" % ordering)
+
+    color = color_in_order(nodeIndices.astype(np.int64), W.indptr, 
+                           W.indices, W.data, ordering == "lipschitz")
+
+  # Blocks list their nodes in the order they were colored
+  nodes = nodeIndices[np.argsort(color[nodeIndices], kind="stable")]
+  sizes = np.bincount(color)
+  blocks = np.split(nodes, np.cumsum(sizes)[:-1])
+
+  # SANITY CHECK
+  alls = np.hstack(blocks)
+
+  assert np.unique(alls).size == alls.size
+  assert alls.size == n_nodes
+  #
+
+  return tuple(blocks)
 
-  return LHS == RHS
 
-def get_rb_general_graph(W, L=None):
+def get_rb_general_graph_slow(W, L=None):
   colorDict = {}
   blockDict = {}
 
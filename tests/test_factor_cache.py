@@ -0,0 +1,61 @@
+import numpy as np
+
+import loss_functions as lf
+from update_rules.factor_cache import FactorCache
+
+
+def test_singular_softmax_block_gives_pinv_step():
+    rng = np.random.RandomState(0)
+    m, d, k = 50, 20, 5
+    A = rng.randn(m, d)
+    b = np.eye(k)[rng.randint(k, size=m)]
+    loss = lf.create_lossObject("sf", A, b, {"L2": 0.})
+    x = np.zeros(d * k)
+
+    # Every class of feature 0: the class factor 0.5 (I - 11^T / k) of
+    # the bound is singular, but Cholesky may still succeed on it
+    block = np.concatenate([np.arange(k), rng.choice(np.arange(k, d * k), 10,
+                                                     replace=False)])
+    H = loss.Hb_func(x, A, b, block)
+    G = rng.randn(block.size)
+
+    cache = FactorCache()
+    d_cached = cache.solve("Hb", block, lambda: H, G)
+
+    assert cache.factor("Hb", block, None)[0] == "pinv"
+    np.testing.assert_allclose(d_cached, np.linalg.pinv(H).dot(G),
+                               rtol=1e-6, atol=1e-8)
+
+
+def test_positive_definite_blocks_are_factored_once():
+    rng = np.random.RandomState(0)
+    blocks = [np.arange(i, i + 4) for i in range(6)]
+    matrices = []
+    for block in blocks:
+        M = rng.randn(4, 4)
+        matrices.append(M.dot(M.T) + 0.1 * np.identity(4))
+
+    # Room for three 4 x 4 factors
+    cache = FactorCache(max_bytes=3 * 16 * 8)
+    n_calls = [0]
+
+    def matrix_func(i):
+        n_calls[0] += 1
+        return matrices[i]
+
+    for _ in range(2):
+        for i, block in enumerate(blocks):
+            rhs = rng.randn(4)
+            x = cache.solve("h", block, lambda: matrix_func(i), rhs)
+
+            np.testing.assert_allclose(x, np.linalg.solve(matrices[i], rhs))
+
+    assert cache.n_bytes <= cache.max_bytes
+    assert len(cache.factors) == 3
+    # Cyclic sweeps over six blocks with room for three refactor each time
+    assert n_calls[0] == 12
+
+    n_calls[0] = 0
+    cache.solve("h", blocks[-1], lambda: matrix_func(5), rng.randn(4))
+    assert n_calls[0] == 0
+    assert cache.factor("h", blocks[-1], None)[0] == "chol"
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+import loss_functions as lf
+
+
+def random_partition(n_params, block_size, seed=0):
+    perm = np.random.RandomState(seed).permutation(n_params)
+    n_blocks = n_params // block_size
+
+    return perm[:n_blocks * block_size].reshape(n_blocks, block_size)
+
+
+def make_loss(name, L2):
+    rng = np.random.RandomState(0)
+    m, d = 40, 12
+    A = sparse.random(m, d, density=0.3, format="csc", random_state=0)
+    args = {"L2": L2, "L1": 0.1}
+
+    if name in ["ls", "lsl1nn"]:
+        b = rng.randn(m)
+    elif name == "lg":
+        b = np.sign(rng.randn(m))
+    elif name == "sf":
+        b = np.eye(6)[rng.randint(6, size=m)]
+    elif name == "bp":
+        # Diagonally dominant, like the D and E systems
+        W = sparse.random(d, d, density=0.3, random_state=0)
+        W = W + W.T
+        A = sparse.diags(np.asarray(W.sum(axis=0)).ravel() + 1.) - W
+        A = A.tocsr()
+        b = rng.randn(d)
+
+    return lf.create_lossObject(name, A, b, args), A, b
+
+
+@pytest.mark.parametrize("name", ["ls", "lsl1nn", "lg", "sf", "bp"])
+@pytest.mark.parametrize("L2", [0., 1e-2])
+def test_Hb_batch_matches_Hb_func(name, L2):
+    loss, A, b = make_loss(name, L2)
+    x = np.zeros(loss.n_params)
+    blocks = random_partition(loss.n_params, 3)
+
+    Hbb = loss.Hb_batch(x, A, b, blocks)
+    for Hb, block in zip(Hbb, blocks):
+        np.testing.assert_allclose(Hb, loss.Hb_func(x, A, b, block))
+
+
+@pytest.mark.parametrize("name", ["ls", "lsl1nn", "lg", "sf", "bp"])
+@pytest.mark.parametrize("L2", [0., 1e-2])
+def test_Hb_full_blocks_match_full_Hb_func(name, L2):
+    loss, A, b = make_loss(name, L2)
+    x = np.zeros(loss.n_params)
+    blocks = random_partition(loss.n_params, 3)
+
+    Hb = lf.dense(loss.Hb_func(x, A, b, block=None))
+    Hbb = loss.Hb_full_blocks(x, A, b, blocks)
+    for Hb_block, block in zip(Hbb, blocks):
+        np.testing.assert_allclose(Hb_block, Hb[np.ix_(block, block)])
+
+
+def test_softmax_Hb_batch_is_tighter_than_full_blocks():
+    # A block within two of six classes is bounded with k = 3
+    loss, A, b = make_loss("sf", 0.)
+    x = np.zeros(loss.n_params)
+    blocks = np.array([[0, 1, 6], [7, 12, 13]])
+
+    assert not np.allclose(loss.Hb_batch(x, A, b, blocks),
+                           loss.Hb_full_blocks(x, A, b, blocks))
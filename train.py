@@ -15,6 +15,7 @@ from selection_rules import VB_selection_rules
 from selection_rules import FB_selection_rules
 from update_rules import update_rules
 from base import utils as ut
+from checks import CheckedMode
 
 
 
@@ -33,10 +34,56 @@ work = np.array([84,  220,  478,  558,  596,  753, 1103, 2009, 2044, 2301, 2410,
        6881, 6917, 6975, 7055, 7121, 7188, 7456, 8217, 8479, 8925, 9190,
        9583, 9681, 9690, 9692, 9793, 9811, 9992])
 
+class ObjectiveTracker:
+    """Tracks f(x) over the iterations of a block coordinate method.
+
+    When the loss implements `f_delta`, f(x) is updated from the change
+    of the coordinates since the previous evaluation. f(x) is recomputed
+    with `f_func` on the first call, every `refresh_every` evaluations
+    (to control drift), and whenever most of x has changed.
+    """
+    def __init__(self, loss, A, b, refresh_every=50):
+        self.loss = loss
+        self.A = A
+        self.b = b
+        self.refresh_every = refresh_every
+
+        self.x = None
+        self.f = None
+        self.n_incremental = 0
+
+    def evaluate(self, x):
+        """Returns f(x) and the path ("incremental" or "full") used."""
+        changed = None
+        if (self.x is not None and hasattr(self.loss, "f_delta") and 
+            self.n_incremental < self.refresh_every):
+            changed = np.flatnonzero(x != self.x)
+
+            if 3 * changed.size > x.size:
+                changed = None
+
+        if changed is None:
+            f = self.loss.f_func(x, self.A, self.b)
+            source = "full"
+            self.n_incremental = 0
+
+        else:
+            delta = x[changed] - self.x[changed]
+            f = self.f + self.loss.f_delta(x, changed, delta, self.A, self.b)
+            source = "incremental"
+            self.n_incremental += 1
+
+        self.x = x.copy()
+        self.f = f
+
+        return f, source
+
+
 def train(dataset_name, loss_name, block_size, partition_rule, 
           selection_rule, 
           update_rule, n_iters, L1, L2, reset=0, optimal=None, 
-          root="", logs_path="", datasets_path=""):
+          root="", logs_path="", datasets_path="", f_refresh=50,
+          Lb_threads=1, checks=None, factor_cache_bytes=2**28):
     
     tmp_block_size = 0 if "-full" in update_rule else block_size
     fname = ("%s/%s_%s_%d_%s_%s_%s_%d_%d_%d.npy" % 
@@ -59,7 +106,13 @@ def train(dataset_name, loss_name, block_size, partition_rule,
         A, b, args = dataset["A"], dataset["b"], dataset["args"]
         
         args.update({"L2":L2, "L1":L1, "block_size":block_size, 
-                     "update_rule":update_rule, "loss":loss_name})
+                     "update_rule":update_rule, "loss":loss_name,
+                     "dataset":dataset_name, "Lb_threads":Lb_threads,
+                     "Lb_cache_dir":os.path.join(logs_path, "Lb_cache"),
+                     "factor_cache_bytes":factor_cache_bytes})
+
+        # Correctness checks, see checks.DEFAULT_CHECKS
+        args["checks"] = CheckedMode(checks)
 
         # loss function
         lossObject = losses.create_lossObject(loss_name, A, b, args)
@@ -70,6 +123,9 @@ def train(dataset_name, loss_name, block_size, partition_rule,
         # Initialize x
         x = np.zeros(lossObject.n_params)
 
+        # Track f(x) incrementally, recomputing it every f_refresh iterations
+        tracker = ObjectiveTracker(lossObject, A, b, refresh_every=f_refresh)
+
         history = []
 
         pbar = tqdm(desc="starting", total=n_iters, leave=True)
@@ -79,9 +135,10 @@ def train(dataset_name, loss_name, block_size, partition_rule,
         avg_update_time = 0
         for i in range(n_iters + 1):
             # Compute loss
-            loss = lossObject.f_func(x, A, b)
+            loss, loss_source = tracker.evaluate(x)
             dis2opt = loss - OPTIMAL_LOSS[dataset_name + "_" + loss_name]
-            history += [{"loss":loss, "iteration":i, "selected":block, "time":avg_update_time, "x":x}]
+            history += [{"loss":loss, "loss_source":loss_source, "iteration":i, 
+                         "selected":block, "time":avg_update_time, "x":x}]
 
             # if i == 10:
             #     import ipdb; ipdb.set_trace()  # breakpoint c7301fd5 //
@@ -100,8 +157,10 @@ def train(dataset_name, loss_name, block_size, partition_rule,
 
 
             # Check increase
-            if (i > 0) and (loss > history[-1]["loss"] + 1e-6): 
-                raise ValueError("loss value has increased...")
+            if i > 0:
+                args["checks"].monotone(i, loss, history[-2]["loss"])
+
+            args["checks"].gradient(i, x, A, b, lossObject)
 
             # Select block
             if partition is None:
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, LinAlgError
+
+
+class FactorCache:
+  """Cholesky factors of block matrices that do not depend on x.
+
+  Factors are keyed by the kind of matrix and the block indices, so a
+  fixed partition pays for each factorization once per run. The least
+  recently used factors are evicted once their total size exceeds
+  `max_bytes`. Matrices that are singular or nearly so, e.g. softmax
+  bounds with L2 = 0, are kept as their pseudo-inverse instead, which
+  gives the minimum-norm step. Cholesky does not always fail on those,
+  so a factor whose smallest pivot is below `rtol` times its largest
+  is rejected.
+  """
+  def __init__(self, max_bytes=2**28, rtol=1e-6):
+    self.max_bytes = max_bytes
+    self.rtol = rtol
+    self.factors = OrderedDict()
+    self.n_bytes = 0
+
+  def factor(self, kind, block, matrix_func):
+    key = (kind, np.asarray(block).tobytes())
+
+    if key in self.factors:
+      self.factors.move_to_end(key)
+      return self.factors[key]
+
+    M = matrix_func()
+    try:
+      factor = ("chol", cho_factor(M, lower=True))
+      pivots = np.abs(np.diag(factor[1][0]))
+      if pivots.min() <= self.rtol * pivots.max():
+        raise LinAlgError("nearly singular block")
+
+      n_bytes = factor[1][0].nbytes
+    except LinAlgError:
+      factor = ("pinv", np.linalg.pinv(M))
+      n_bytes = factor[1].nbytes
+
+    if n_bytes <= self.max_bytes:
+      self.factors[key] = factor
+      self.n_bytes += n_bytes
+
+      while self.n_bytes > self.max_bytes:
+        _, (method, old) = self.factors.popitem(last=False)
+        self.n_bytes -= old[0].nbytes if method == "chol" else old.nbytes
+
+    return factor
+
+  def solve(self, kind, block, matrix_func, rhs):
+    """Solves M x = rhs for the block matrix M = matrix_func()."""
+    method, factor = self.factor(kind, block, matrix_func)
+
+    if method == "chol":
+      return cho_solve(factor, rhs)
+
+    return factor.dot(rhs)
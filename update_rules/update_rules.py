@@ -9,6 +9,8 @@ import numpy as np
 np.set_printoptions(threshold=sys.maxsize)
 
 from . import line_search
+from .factor_cache import FactorCache
+from loss_functions import dense
 import cvxopt
 
 import utils as ut 
@@ -20,7 +22,27 @@ from scipy.optimize import minimize
 
 cvxopt.solvers.options['show_progress'] = False
 
+# Losses whose Hb_func, or h_func, does not depend on x
+CONSTANT_HB = ["ls", "lsl1nn", "lg", "sf", "bp"]
+CONSTANT_H = ["ls", "lsl1nn", "bp"]
+
+def get_factor_cache(args):
+  # Block factorizations shared by all iterations of a run
+  if "factor_cache" not in args:
+    args["factor_cache"] = FactorCache(args.get("factor_cache_bytes", 2**28))
+
+  return args["factor_cache"]
+
 def update(rule, x, A, b, loss, args, block, iteration):
+  x, args = update_block(rule, x, A, b, loss, args, block, iteration)
+
+  # Patch the cached products (e.g. Ax - b) of the loss with the new x
+  if hasattr(loss, "commit"):
+    loss.commit(x)
+
+  return x, args
+
+def update_block(rule, x, A, b, loss, args, block, iteration):
   f_func = loss.f_func
   g_func = loss.g_func
   h_func = loss.h_func
@@ -46,8 +68,13 @@ def update(rule, x, A, b, loss, args, block, iteration):
   elif rule in ["newtonUpperBound", "Hb"]:    
 
     G = g_func(x, A, b, block)
-    H = loss.Hb_func(x, A, b, block)
-    d = - np.linalg.pinv(H).dot(G)
+
+    if args.get("loss") in CONSTANT_HB:
+      Hb_func = lambda: loss.Hb_func(x, A, b, block)
+      d = - get_factor_cache(args).solve("Hb", block, Hb_func, G)
+    else:
+      H = loss.Hb_func(x, A, b, block)
+      d = - np.linalg.pinv(H).dot(G)
 
     x[block] = x[block] + d
 
@@ -78,12 +105,17 @@ def update(rule, x, A, b, loss, args, block, iteration):
   # Line Search
   elif rule in ["LS", "LS-full"]:    
 
-    H = h_func(x, A, b, block)
-
     g = g_func(x, A, b, block)
 
+    if rule == "LS" and args.get("loss") in CONSTANT_H:
+      H_func = lambda: h_func(x, A, b, block)
+      d = get_factor_cache(args).solve("h", block, H_func, g)
+    else:
+      H = h_func(x, A, b, block)
+      d = Main.solve(H, g)
+
     f_simple = lambda x: f_func(x, A, b)
-    d_func = lambda alpha: (- alpha * Main.solve(H, g))
+    d_func = lambda alpha: (- alpha * d)
 
     alpha = line_search.perform_line_search(x.copy(), g, 
                                 block, f_simple, d_func, alpha0=1.0,
@@ -206,7 +238,8 @@ def update(rule, x, A, b, loss, args, block, iteration):
     k = block.size
 
     # 0.5*xb ^T (Ab^T Ab) xb + xb^T[Ab^T (Ac xc - b) + lambda*ones(nb)]
-    Ab = matrix(A[:, block])
+    Ab = A[:, block]
+    Ab = matrix(Ab.toarray() if sparse.issparse(Ab) else Ab)
     bb = matrix(A[:, non_block].dot(x[non_block]) - b)
 
     P = Ab.T*Ab
@@ -229,18 +262,14 @@ def update(rule, x, A, b, loss, args, block, iteration):
   ### BELIEF PROPAGATION ALGORITHMS
 
   elif rule in ["bpExact", "bpExact-lap"]:
-      n_params = x.size
-      all_indices = np.arange(n_params)
+      A_bb = dense(A[block][:, block])
       
-      non_block_indices = np.delete(all_indices, block)
-      
-      A_bc = A[block][:, non_block_indices]
-      A_bb = A[block][:, block]
-      
-      b_prime = A_bc.dot(x[non_block_indices]) - b[block]
+      # A_bc x_c - b_b, read from the rows of A in the block
+      b_prime = A[block].dot(x) - A_bb.dot(x[block]) - b[block]
 
       if rule == "bpExact":
-        x[block] = Main.solve(A_bb, -b_prime)
+        x[block] = get_factor_cache(args).solve("A_bb", block, lambda: A_bb, 
+                                                -b_prime)
         # are you missing the x[block] + ?
         # Ans:
         # No, this is the exact update of the objective function formulation under
@@ -254,25 +283,20 @@ def update(rule, x, A, b, loss, args, block, iteration):
       if iteration == 0:
         Main.reset_solver()
 
-      x = Main.solve_SDDM(A, b, reuse_solver=True)
+      x = Main.solve_SDDM(dense(A), b, reuse_solver=True)
       return x, args
 
 
   elif rule == "bpExact-full":
-      x = Main.solve(A, b)
+      x = Main.solve(dense(A), b)
       return x, args
 
 
   elif rule == "bpGabp":
-      A_sub = A[block][:, block]
+      A_sub = dense(A[block][:, block])
 
       ######## ADDED
-      _, n_features = A.shape
-      all_indices = np.arange(n_features)
-      non_block_indices = np.delete(all_indices, block)
-      
-      A_bc = A[block][:, non_block_indices]
-      b_sub = A_bc.dot(x[non_block_indices]) - b[block]
+      b_sub = A[block].dot(x) - A_sub.dot(x[block]) - b[block]
       b_sub = - b_sub
       
       #########